@@ -1,4 +1,5 @@
 import os
+import sys
 import shutil
 from fastapi import FastAPI, File, UploadFile, HTTPException, Query
 from fastapi.responses import FileResponse, JSONResponse, RedirectResponse
@@ -7,6 +8,10 @@ import uuid
 import subprocess
 from fastapi.staticfiles import StaticFiles
 
+# 输出收尾参数与 moov 位置校验复用 api/_output.py，与线上接口保持一致（同样读取 OUTPUT_* 环境变量）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from api._output import audio_output_args, moov_before_mdat, video_output_args
+
 app = FastAPI()
 
 # 允许跨域，方便前端开发
@@ -44,6 +49,7 @@ def compress_video(input_path, output_path, progress_path=None):
         "-vf", "scale=-2:480",
         "-c:v", "libx264", "-preset", "veryfast", "-crf", "32",
         "-c:a", "aac", "-b:a", "64k",
+        *video_output_args(),
     ]
     if progress_path:
         cmd += ["-progress", progress_path, "-nostats"]
@@ -54,6 +60,7 @@ def compress_audio(input_path, output_path, progress_path=None):
     cmd = [
         "ffmpeg", "-y", "-i", input_path,
         "-vn", "-ar", "44100", "-ac", "2", "-b:a", "64k",
+        *audio_output_args(),
     ]
     if progress_path:
         cmd += ["-progress", progress_path, "-nostats"]
@@ -84,6 +91,7 @@ async def upload_file(file: UploadFile = File(...), task_id: str = Query(None)):
             compress_video(input_path, compressed_video, progress_path)
             result["video"] = f"/download/{os.path.basename(compressed_video)}"
             result["size"] = os.path.getsize(compressed_video)
+            result["faststart"] = moov_before_mdat(compressed_video)
         elif is_audio(file.filename):
             compressed_audio = os.path.join(OUTPUT_DIR, file_id + "_compressed.mp3")
             compress_audio(input_path, compressed_audio, progress_path)
@@ -0,0 +1,209 @@
+"""音频压缩引擎：探测声道/采样率，区分语音与音乐，选择编码器与匹配的容器
+
+- 语音（单声道、低采样率或低码率）优先 Opus VoIP 模式，其次 HE-AAC / AAC-LC / MP3
+- 音乐保留立体声，使用较高码率
+- 目标码率不超过源文件码率，单声道不会被扩成立体声
+- 可选单遍 EBU R128 响度标准化（loudnorm）
+- 多个短音频可合并为一个 ffmpeg 进程处理，避免每个文件都启动一次 ffmpeg
+"""
+import json
+import asyncio
+import logging
+import os
+from typing import Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+AUDIO_FORMATS = ("auto", "opus", "aac", "mp3")
+AUDIO_CONTENT_TYPES = ("speech", "music")
+LOUDNORM_FILTER = "loudnorm=I=-16:TP=-1.5:LRA=11"
+
+# (编码格式, 内容类型) -> 码率（kbps，按立体声计；单声道减半但不低于下限）
+AUDIO_BITRATES = {
+    ("opus", "speech"): 24,
+    ("opus", "music"): 64,
+    ("aac_he", "speech"): 32,
+    ("aac_he", "music"): 48,
+    ("aac", "speech"): 48,
+    ("aac", "music"): 96,
+    ("mp3", "speech"): 48,
+    ("mp3", "music"): 96,
+}
+MIN_BITRATE = 16
+
+# 编码器能力缓存：ffmpeg 路径 -> 已编译的编码器集合
+_encoder_cache: Dict[str, Set[str]] = {}
+
+
+def ffprobe_for(ffmpeg_cmd: str) -> str:
+    """与 ffmpeg 同目录的 ffprobe"""
+    directory = os.path.dirname(ffmpeg_cmd)
+    return os.path.join(directory, "ffprobe") if directory else "ffprobe"
+
+
+async def available_encoders(ffmpeg_cmd: str) -> Set[str]:
+    """列出本地 ffmpeg 可用的编码器（结果按路径缓存）"""
+    if ffmpeg_cmd not in _encoder_cache:
+        encoders = set()
+        try:
+            process = await asyncio.create_subprocess_exec(
+                ffmpeg_cmd, "-hide_banner", "-encoders",
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            stdout, _ = await process.communicate()
+            for line in stdout.decode(errors="replace").splitlines():
+                parts = line.split()
+                # 形如 " A....D libopus   libopus Opus"
+                if len(parts) >= 2 and len(parts[0]) == 6 and parts[0][0] in "VAS":
+                    encoders.add(parts[1])
+        except FileNotFoundError:
+            pass
+        _encoder_cache[ffmpeg_cmd] = encoders
+    return _encoder_cache[ffmpeg_cmd]
+
+
+async def probe_audio(ffmpeg_cmd: str, input_path: str) -> dict:
+    """用 ffprobe 读取第一条音轨的声道数、采样率和码率，失败时返回空字典"""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            ffprobe_for(ffmpeg_cmd), "-v", "error",
+            "-select_streams", "a:0",
+            "-show_entries", "stream=codec_name,channels,channel_layout,sample_rate,bit_rate:format=bit_rate,duration",
+            "-of", "json",
+            input_path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, _ = await asyncio.wait_for(process.communicate(), timeout=30)
+        data = json.loads(stdout.decode() or "{}")
+    except (FileNotFoundError, ValueError, asyncio.TimeoutError):
+        return {}
+
+    streams = data.get("streams") or [{}]
+    stream, fmt = streams[0], data.get("format", {})
+
+    def number(value, cast=int):
+        try:
+            return cast(value)
+        except (TypeError, ValueError):
+            return None
+
+    return {
+        "codec": stream.get("codec_name"),
+        "channels": number(stream.get("channels")),
+        "channel_layout": stream.get("channel_layout"),
+        "sample_rate": number(stream.get("sample_rate")),
+        "bit_rate": number(stream.get("bit_rate")) or number(fmt.get("bit_rate")),
+        "duration": number(fmt.get("duration"), float),
+    }
+
+
+def classify_content(info: dict) -> str:
+    """根据探测结果粗略判断是语音还是音乐
+
+    单声道、采样率不高于 24kHz 或码率不高于 48kbps 的音频通常是录音/语音备忘录。
+    """
+    channels = info.get("channels")
+    sample_rate = info.get("sample_rate")
+    bit_rate = info.get("bit_rate")
+    if channels == 1:
+        return "speech"
+    if sample_rate and sample_rate <= 24000:
+        return "speech"
+    if bit_rate and bit_rate <= 48000:
+        return "speech"
+    return "music"
+
+
+def choose_audio_profile(info: dict, encoders: Set[str], audio_format: str = "auto",
+                         content: Optional[str] = None) -> dict:
+    """选择编码器、码率、声道、采样率和容器扩展名"""
+    content = content or classify_content(info)
+    channels = 1 if content == "speech" or info.get("channels") == 1 else 2
+
+    if audio_format == "auto":
+        audio_format = "opus" if "libopus" in encoders else "aac"
+    if audio_format == "opus" and "libopus" not in encoders:
+        audio_format = "aac"
+    if audio_format == "mp3" and "libmp3lame" not in encoders:
+        audio_format = "aac"
+
+    if audio_format == "opus":
+        codec = "opus"
+        args = ["-c:a", "libopus", "-application", "voip" if content == "speech" else "audio"]
+        sample_rate, ext = 48000, ".opus"
+    elif audio_format == "aac" and "libfdk_aac" in encoders:
+        codec = "aac_he"
+        args = ["-c:a", "libfdk_aac", "-profile:a", "aac_he"]
+        sample_rate, ext = 44100, ".m4a"
+    elif audio_format == "aac":
+        codec = "aac"
+        args = ["-c:a", "aac"]
+        sample_rate, ext = (32000 if content == "speech" else 44100), ".m4a"
+    else:
+        codec = "mp3"
+        args = ["-c:a", "libmp3lame"]
+        sample_rate, ext = (22050 if content == "speech" else 44100), ".mp3"
+
+    if codec != "opus" and info.get("sample_rate"):
+        sample_rate = min(sample_rate, info["sample_rate"])
+
+    bitrate = AUDIO_BITRATES[(codec, content)]
+    if channels == 1:
+        bitrate = max(bitrate // 2 if content == "music" else bitrate, MIN_BITRATE)
+    if info.get("bit_rate"):
+        # 不要比源文件码率更高
+        bitrate = max(min(bitrate, info["bit_rate"] // 1000), MIN_BITRATE)
+
+    return {
+        "format": audio_format,
+        "codec": codec,
+        "content": content,
+        "channels": channels,
+        "sample_rate": sample_rate,
+        "bitrate": bitrate,
+        "ext": ext,
+        "encoder": args[1],
+        "codec_args": args,
+        "duration": info.get("duration"),
+    }
+
+
+def audio_encode_args(profile: dict, loudnorm: bool = False) -> list:
+    """根据音频配置生成 ffmpeg 输出参数（不含输入与输出文件名）"""
+    args = ["-vn", *profile["codec_args"], "-b:a", f"{profile['bitrate']}k",
+            "-ac", str(profile["channels"])]
+    if loudnorm:
+        args += ["-af", LOUDNORM_FILTER]
+    # loudnorm 内部会升采样，采样率必须放在滤镜之后显式指定
+    args += ["-ar", str(profile["sample_rate"])]
+    if profile["ext"] == ".m4a":
+        args += ["-movflags", "+faststart"]
+    return args
+
+
+async def plan_audio(ffmpeg_cmd: str, input_path: str, audio_format: str = "auto",
+                     content: Optional[str] = None) -> dict:
+    """探测输入并返回音频配置"""
+    info = await probe_audio(ffmpeg_cmd, input_path)
+    encoders = await available_encoders(ffmpeg_cmd)
+    profile = choose_audio_profile(info, encoders, audio_format, content)
+    logger.info(f"音频配置 - {os.path.basename(input_path)}: {info} -> {profile['codec']} "
+                f"{profile['bitrate']}k {profile['channels']}ch {profile['content']}")
+    return profile
+
+
+def build_batch_command(ffmpeg_cmd: str, jobs: List[dict], loudnorm: bool = False,
+                        extra_output_args: Optional[list] = None) -> list:
+    """把多个音频任务合并为一条 ffmpeg 命令（多输入、多输出）
+
+    jobs 中每项包含 input_path、output_path 和 profile。
+    """
+    cmd = [ffmpeg_cmd, "-y", "-hide_banner"]
+    for job in jobs:
+        cmd += ["-i", job["input_path"]]
+    for index, job in enumerate(jobs):
+        cmd += ["-map", f"{index}:a:0", *audio_encode_args(job["profile"], loudnorm)]
+        cmd += [*(extra_output_args or []), job["output_path"]]
+    return cmd
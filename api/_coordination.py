@@ -0,0 +1,211 @@
+"""跨进程任务协调：全局并发名额、正在处理的任务表和取消标记
+
+默认使用进程内实现（单 worker，与原先的 set/Semaphore 行为一致）。
+设置环境变量 SHARED_STATE_DB=/path/to/state.db 后改用 SQLite 文件，
+`uvicorn --workers N` 下的所有 worker 共享同一个并发上限、任务表和取消请求。
+"""
+import os
+import time
+import random
+import asyncio
+import sqlite3
+import logging
+from typing import Dict, List, Optional
+
+try:
+    from ._sqlite import LazySQLite
+except ImportError:
+    from _sqlite import LazySQLite
+
+logger = logging.getLogger(__name__)
+
+SHARED_STATE_DB = os.environ.get("SHARED_STATE_DB")
+SLOT_POLL_INTERVAL = 0.1  # 等待并发名额时的轮询间隔（秒）
+SLOT_POLL_MAX_INTERVAL = 2.0  # 共享模式下轮询间隔按指数退避增长的上限（秒）
+
+
+def _pid_alive(pid: int) -> bool:
+    """判断 worker 进程是否仍存活，用于回收崩溃 worker 遗留的名额"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+
+class LocalCoordinator:
+    """进程内协调器，仅在单 worker 部署下保证并发上限"""
+
+    shared = False
+
+    def __init__(self):
+        self._jobs: Dict[str, dict] = {}
+
+    def try_acquire(self, task_id: str, kind: str, limit: int) -> bool:
+        if task_id in self._jobs or len(self._jobs) >= limit:
+            return False
+        self._jobs[task_id] = {
+            "task_id": task_id,
+            "kind": kind,
+            "pid": os.getpid(),
+            "started_at": time.time(),
+            "cancel_requested": False,
+        }
+        return True
+
+    def release(self, task_id: str):
+        self._jobs.pop(task_id, None)
+
+    def request_cancel(self, task_id: str) -> bool:
+        job = self._jobs.get(task_id)
+        if job is None:
+            return False
+        job["cancel_requested"] = True
+        return True
+
+    def is_cancelled(self, task_id: str) -> bool:
+        job = self._jobs.get(task_id)
+        return bool(job and job["cancel_requested"])
+
+    def clear_cancel(self, task_id: str):
+        job = self._jobs.get(task_id)
+        if job is not None:
+            job["cancel_requested"] = False
+
+    def get(self, task_id: str) -> Optional[dict]:
+        job = self._jobs.get(task_id)
+        return dict(job) if job else None
+
+    def active_count(self) -> int:
+        return len(self._jobs)
+
+    def list_active(self) -> List[dict]:
+        return [dict(job) for job in self._jobs.values()]
+
+
+class SQLiteCoordinator(LazySQLite):
+    """基于 SQLite 文件的协调器，同一主机上的所有 worker 共享状态"""
+
+    shared = True
+
+    def _create_schema(self, conn: sqlite3.Connection):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS active_jobs (
+                task_id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                pid INTEGER NOT NULL,
+                started_at REAL NOT NULL,
+                cancel_requested INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+
+    def _reap_dead_workers(self, conn: sqlite3.Connection):
+        for row in conn.execute("SELECT task_id, pid FROM active_jobs").fetchall():
+            if not _pid_alive(row["pid"]):
+                logger.warning(f"回收已退出 worker 的任务名额: {row['task_id']} (pid {row['pid']})")
+                conn.execute("DELETE FROM active_jobs WHERE task_id = ?", (row["task_id"],))
+
+    def try_acquire(self, task_id: str, kind: str, limit: int) -> bool:
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._reap_dead_workers(conn)
+                count = conn.execute("SELECT COUNT(*) FROM active_jobs").fetchone()[0]
+                exists = conn.execute(
+                    "SELECT 1 FROM active_jobs WHERE task_id = ?", (task_id,)
+                ).fetchone()
+                if exists or count >= limit:
+                    conn.execute("ROLLBACK")
+                    return False
+                conn.execute(
+                    "INSERT INTO active_jobs (task_id, kind, pid, started_at) VALUES (?, ?, ?, ?)",
+                    (task_id, kind, os.getpid(), time.time())
+                )
+                conn.execute("COMMIT")
+                return True
+            except Exception:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+
+    def release(self, task_id: str):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM active_jobs WHERE task_id = ?", (task_id,))
+
+    def request_cancel(self, task_id: str) -> bool:
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE active_jobs SET cancel_requested = 1 WHERE task_id = ?", (task_id,)
+            )
+            return cursor.rowcount > 0
+
+    def is_cancelled(self, task_id: str) -> bool:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT cancel_requested FROM active_jobs WHERE task_id = ?", (task_id,)
+            ).fetchone()
+            return bool(row and row["cancel_requested"])
+
+    def clear_cancel(self, task_id: str):
+        with self._connect() as conn:
+            conn.execute("UPDATE active_jobs SET cancel_requested = 0 WHERE task_id = ?", (task_id,))
+
+    def get(self, task_id: str) -> Optional[dict]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM active_jobs WHERE task_id = ?", (task_id,)).fetchone()
+            return self._to_dict(row) if row else None
+
+    def active_count(self) -> int:
+        with self._connect() as conn:
+            self._reap_dead_workers(conn)
+            return conn.execute("SELECT COUNT(*) FROM active_jobs").fetchone()[0]
+
+    def list_active(self) -> List[dict]:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT * FROM active_jobs ORDER BY started_at").fetchall()
+            return [self._to_dict(row) for row in rows]
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> dict:
+        job = dict(row)
+        job["cancel_requested"] = bool(job["cancel_requested"])
+        return job
+
+
+def create_coordinator():
+    """根据 SHARED_STATE_DB 环境变量选择协调器实现"""
+    if SHARED_STATE_DB:
+        logger.info(f"多 worker 模式，共享状态数据库: {SHARED_STATE_DB}")
+        return SQLiteCoordinator(SHARED_STATE_DB)
+    return LocalCoordinator()
+
+
+async def coordinated(coordinator, method: str, *args):
+    """在异步代码中调用协调器方法
+
+    SQLite 协调器的每次调用都要打开连接，写操作可能等待其他 worker 的写锁（最长 10 秒），
+    因此放到线程池中执行，避免阻塞事件循环；进程内协调器直接调用。
+    """
+    call = getattr(coordinator, method)
+    if not coordinator.shared:
+        return call(*args)
+    return await asyncio.get_running_loop().run_in_executor(None, call, *args)
+
+
+async def wait_for_slot(coordinator, task_id: str, kind: str, limit: int):
+    """等待直到获得并发名额（替代进程内 Semaphore，对所有 worker 生效）
+
+    共享模式下每次尝试都是一次 SQLite 写事务，轮询间隔按指数退避（带随机抖动）增长，
+    避免大量等待中的请求反复争抢写锁。
+    """
+    interval = SLOT_POLL_INTERVAL
+    while not await coordinated(coordinator, "try_acquire", task_id, kind, limit):
+        if not coordinator.shared:
+            await asyncio.sleep(SLOT_POLL_INTERVAL)
+            continue
+        await asyncio.sleep(random.uniform(interval / 2, interval))
+        interval = min(interval * 2, SLOT_POLL_MAX_INTERVAL)
@@ -0,0 +1,215 @@
+"""任务历史：持久化每个任务的大小、耗时、配置与失败原因，并据此执行按客户端的配额
+
+    JOB_HISTORY_DB=/tmp/autovideozip_jobs.db   历史数据库路径
+    JOB_HISTORY_DAYS=30                        历史保留天数
+    QUOTA_ACTIVE_PER_CLIENT=1                  每个客户端同时处理的任务数
+    QUOTA_JOBS_PER_HOUR=30                     每个客户端每小时的任务数
+    QUOTA_BYTES_PER_HOUR=524288000             每个客户端每小时上传的字节数
+配额设为 0 表示不限制。
+"""
+import os
+import json
+import time
+import sqlite3
+import logging
+from typing import List, Optional, Tuple
+
+try:
+    from ._sqlite import LazySQLite
+except ImportError:
+    from _sqlite import LazySQLite
+
+logger = logging.getLogger(__name__)
+
+JOB_HISTORY_DB = os.environ.get("JOB_HISTORY_DB", "/tmp/autovideozip_jobs.db")
+JOB_HISTORY_DAYS = int(os.environ.get("JOB_HISTORY_DAYS", "30"))
+QUOTA_ACTIVE_PER_CLIENT = int(os.environ.get("QUOTA_ACTIVE_PER_CLIENT", "1"))
+QUOTA_JOBS_PER_HOUR = int(os.environ.get("QUOTA_JOBS_PER_HOUR", "30"))
+QUOTA_BYTES_PER_HOUR = int(os.environ.get("QUOTA_BYTES_PER_HOUR", str(500 * 1024 * 1024)))
+STALE_RUNNING_SECONDS = 600  # 超过该时间仍为 running 的记录视为进程崩溃遗留，不计入并发配额
+
+
+class DuplicateTask(Exception):
+    """任务 ID 已被其他任务使用"""
+
+
+class JobHistory(LazySQLite):
+    """基于 SQLite 的任务历史表"""
+
+    def __init__(self, path: str = JOB_HISTORY_DB):
+        super().__init__(path)
+
+    def _create_schema(self, conn: sqlite3.Connection):
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                task_id TEXT PRIMARY KEY,
+                client TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                filename TEXT,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                finished_at REAL,
+                input_size INTEGER,
+                output_size INTEGER,
+                media_seconds REAL,
+                encode_seconds REAL,
+                encoder_fps REAL,
+                profile TEXT,
+                error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_created ON jobs (created_at);
+            CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs (status, created_at);
+            CREATE INDEX IF NOT EXISTS idx_jobs_client_created ON jobs (client, created_at);
+        """)
+
+    def start(self, task_id: str, client: str, kind: str, filename: str,
+              input_size: Optional[int], profile: Optional[dict] = None):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO jobs (task_id, client, kind, filename, status, created_at, input_size, profile) "
+                "VALUES (?, ?, ?, ?, 'running', ?, ?, ?)",
+                (task_id, client, kind, filename, time.time(), input_size,
+                 json.dumps(profile, ensure_ascii=False) if profile else None)
+            )
+
+    def finish(self, task_id: str, status: str, output_size: Optional[int] = None,
+               media_seconds: Optional[float] = None, encode_seconds: Optional[float] = None,
+               encoder_fps: Optional[float] = None, profile: Optional[dict] = None,
+               error: Optional[str] = None):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, output_size = ?, media_seconds = ?, "
+                "encode_seconds = ?, encoder_fps = ?, profile = COALESCE(?, profile), error = ? "
+                "WHERE task_id = ?",
+                (status, time.time(), output_size, media_seconds, encode_seconds, encoder_fps,
+                 json.dumps(profile, ensure_ascii=False) if profile else None, error, task_id)
+            )
+
+    def get(self, task_id: str) -> Optional[dict]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE task_id = ?", (task_id,)).fetchone()
+            return self._to_dict(row) if row else None
+
+    def list(self, status: Optional[str] = None, client: Optional[str] = None,
+             since: Optional[float] = None, limit: int = 50, offset: int = 0) -> List[dict]:
+        clauses, params = [], []
+        if status:
+            clauses.append("status = ?")
+            params.append(status)
+        if client:
+            clauses.append("client = ?")
+            params.append(client)
+        if since:
+            clauses.append("created_at >= ?")
+            params.append(since)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT * FROM jobs {where} ORDER BY created_at DESC LIMIT ? OFFSET ?",
+                (*params, limit, offset)
+            ).fetchall()
+            return [self._to_dict(row) for row in rows]
+
+    def stats(self, since: float) -> dict:
+        """按类型汇总任务数、成功率、字节数、压缩率、耗时和编码速度"""
+        with self._connect() as conn:
+            by_status = {
+                row["status"]: row["count"]
+                for row in conn.execute(
+                    "SELECT status, COUNT(*) AS count FROM jobs WHERE created_at >= ? GROUP BY status",
+                    (since,)
+                )
+            }
+            by_kind = [
+                dict(row) for row in conn.execute("""
+                    SELECT kind,
+                           COUNT(*) AS jobs,
+                           SUM(input_size) AS input_bytes,
+                           SUM(output_size) AS output_bytes,
+                           AVG(1.0 - CAST(output_size AS REAL) / input_size) AS avg_compression_ratio,
+                           AVG(encode_seconds) AS avg_encode_seconds,
+                           MAX(encode_seconds) AS max_encode_seconds,
+                           SUM(media_seconds) AS media_seconds,
+                           AVG(encoder_fps) AS avg_encoder_fps
+                    FROM jobs
+                    WHERE status = 'success' AND created_at >= ?
+                    GROUP BY kind
+                """, (since,))
+            ]
+            failures = [
+                dict(row) for row in conn.execute("""
+                    SELECT error, COUNT(*) AS count FROM jobs
+                    WHERE status != 'success' AND status != 'running' AND created_at >= ?
+                    GROUP BY error ORDER BY count DESC LIMIT 10
+                """, (since,))
+            ]
+        return {"by_status": by_status, "by_kind": by_kind, "top_failures": failures}
+
+    def check_quota(self, client: str, incoming_bytes: int = 0) -> Tuple[bool, str]:
+        """检查客户端是否超出并发、任务数或字节配额"""
+        with self._connect() as conn:
+            return self._check_quota(conn, client, incoming_bytes)
+
+    def reserve(self, task_id: str, client: str, kind: str, filename: str,
+                input_size: Optional[int]) -> Tuple[bool, str]:
+        """检查配额并写入 running 记录，两步在同一事务中完成
+
+        同一客户端的并发上传（包括落在其他 worker 上的）按顺序通过检查，
+        先到的请求写入的记录会计入后到请求的并发配额。任务 ID 已存在时抛出 DuplicateTask，
+        不会覆盖其他任务的记录。
+        """
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                allowed, message = self._check_quota(conn, client, input_size or 0)
+                if conn.execute("SELECT 1 FROM jobs WHERE task_id = ?", (task_id,)).fetchone():
+                    raise DuplicateTask(task_id)
+                if allowed:
+                    conn.execute(
+                        "INSERT INTO jobs (task_id, client, kind, filename, status, created_at, input_size) "
+                        "VALUES (?, ?, ?, ?, 'running', ?, ?)",
+                        (task_id, client, kind, filename, time.time(), input_size)
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+        return allowed, message
+
+    def release(self, task_id: str):
+        """撤销尚未开始处理的预留记录，只能对 reserve 成功的任务调用"""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM jobs WHERE task_id = ? AND status = 'running'", (task_id,))
+
+    @staticmethod
+    def _check_quota(conn: sqlite3.Connection, client: str, incoming_bytes: int) -> Tuple[bool, str]:
+        now = time.time()
+        active = conn.execute(
+            "SELECT COUNT(*) FROM jobs WHERE client = ? AND status = 'running' AND created_at >= ?",
+            (client, now - STALE_RUNNING_SECONDS)
+        ).fetchone()[0]
+        hourly = conn.execute(
+            "SELECT COUNT(*) AS jobs, COALESCE(SUM(input_size), 0) AS bytes FROM jobs "
+            "WHERE client = ? AND created_at >= ?",
+            (client, now - 3600)
+        ).fetchone()
+        if QUOTA_ACTIVE_PER_CLIENT and active >= QUOTA_ACTIVE_PER_CLIENT:
+            return False, "您已有任务正在处理，请等待完成后再上传"
+        if QUOTA_JOBS_PER_HOUR and hourly["jobs"] >= QUOTA_JOBS_PER_HOUR:
+            return False, f"每小时最多处理 {QUOTA_JOBS_PER_HOUR} 个文件，请稍后重试"
+        if QUOTA_BYTES_PER_HOUR and hourly["bytes"] + incoming_bytes > QUOTA_BYTES_PER_HOUR:
+            return False, f"每小时最多上传 {QUOTA_BYTES_PER_HOUR // 1024 // 1024}MB，请稍后重试"
+        return True, "ok"
+
+    def prune(self, days: int = JOB_HISTORY_DAYS) -> int:
+        with self._connect() as conn:
+            cursor = conn.execute("DELETE FROM jobs WHERE created_at < ?", (time.time() - days * 86400,))
+            return cursor.rowcount
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> dict:
+        job = dict(row)
+        if job.get("profile"):
+            job["profile"] = json.loads(job["profile"])
+        return job
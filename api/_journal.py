@@ -0,0 +1,138 @@
+"""任务日志：记录已接收但尚未完成的任务，服务重启后重新排队被中断的任务
+
+上传文件保存后即写入日志（输入路径、参数、所属 worker 的 pid），任务成功后记录结果，
+失败或取消时删除。进程被杀死或部署重启时，日志中仍处于 running 且 pid 已不存在的任务
+会在下一次启动时被重新认领并从头编码；输入文件在任务结束前一直保留。
+
+    JOB_JOURNAL_DB=/tmp/autovideozip_journal.db   日志数据库路径
+    JOB_RESUME_ATTEMPTS=2                         单个任务最多重新排队的次数，防止崩溃循环
+"""
+import os
+import json
+import time
+import sqlite3
+import logging
+from typing import List, Optional
+
+try:
+    from ._coordination import _pid_alive
+    from ._sqlite import LazySQLite
+except ImportError:
+    from _coordination import _pid_alive
+    from _sqlite import LazySQLite
+
+logger = logging.getLogger(__name__)
+
+JOB_JOURNAL_DB = os.environ.get("JOB_JOURNAL_DB", "/tmp/autovideozip_journal.db")
+JOB_RESUME_ATTEMPTS = int(os.environ.get("JOB_RESUME_ATTEMPTS", "2"))
+DONE_RETENTION_SECONDS = 3600  # 已完成任务的结果保留时间，与输出文件的清理周期一致
+
+
+class JobJournal(LazySQLite):
+    """基于 SQLite 的任务日志，多个 worker 可共享同一文件"""
+
+    def __init__(self, path: str = JOB_JOURNAL_DB):
+        super().__init__(path)
+
+    def _create_schema(self, conn: sqlite3.Connection):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS journal (
+                task_id TEXT PRIMARY KEY,
+                coalesce_key TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                client TEXT NOT NULL,
+                input_path TEXT NOT NULL,
+                options TEXT NOT NULL,
+                status TEXT NOT NULL,
+                pid INTEGER NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL,
+                result TEXT
+            )
+        """)
+
+    def add(self, task_id: str, coalesce_key: str, kind: str, filename: str, client: str,
+            input_path: str, options: dict):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO journal (task_id, coalesce_key, kind, filename, client, input_path, "
+                "options, status, pid, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, 'running', ?, ?)",
+                (task_id, coalesce_key, kind, filename, client, input_path,
+                 json.dumps(options), os.getpid(), time.time())
+            )
+
+    def complete(self, task_id: str, result: dict):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE journal SET status = 'done', result = ?, updated_at = ? WHERE task_id = ?",
+                (json.dumps(result, ensure_ascii=False), time.time(), task_id)
+            )
+
+    def remove(self, task_id: str):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM journal WHERE task_id = ?", (task_id,))
+
+    def get(self, task_id: str) -> Optional[dict]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM journal WHERE task_id = ?", (task_id,)).fetchone()
+            return self._to_dict(row) if row else None
+
+    def pending_inputs(self) -> set:
+        """未完成任务的输入文件，清理临时文件时必须保留"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT input_path FROM journal WHERE status = 'running'").fetchall()
+            return {row["input_path"] for row in rows}
+
+    def claim_interrupted(self) -> List[dict]:
+        """认领所属 worker 已退出的 running 任务，归属改为当前进程
+
+        只在 worker 启动时调用：此时本进程还没有任务，记录中与本进程 pid 相同的任务
+        来自上一次运行（容器内重启后 pid 常常相同）。超过 JOB_RESUME_ATTEMPTS 次或
+        输入文件已丢失的任务直接放弃。
+        """
+        claimed, abandoned = [], []
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute("SELECT * FROM journal WHERE status = 'running'").fetchall()
+                for row in rows:
+                    if row["pid"] != os.getpid() and _pid_alive(row["pid"]):
+                        continue
+                    if row["attempts"] >= JOB_RESUME_ATTEMPTS or not os.path.exists(row["input_path"]):
+                        conn.execute("DELETE FROM journal WHERE task_id = ?", (row["task_id"],))
+                        abandoned.append(self._to_dict(row))
+                        continue
+                    conn.execute(
+                        "UPDATE journal SET pid = ?, attempts = attempts + 1, updated_at = ? WHERE task_id = ?",
+                        (os.getpid(), time.time(), row["task_id"])
+                    )
+                    claimed.append(self._to_dict(row))
+                conn.execute("COMMIT")
+            except Exception:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+        for job in abandoned:
+            logger.warning(f"放弃中断的任务: {job['task_id']} (已重试 {job['attempts']} 次或输入文件丢失)")
+            try:
+                os.remove(job["input_path"])
+            except OSError:
+                pass
+        return claimed
+
+    def prune(self) -> int:
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "DELETE FROM journal WHERE status = 'done' AND updated_at < ?",
+                (time.time() - DONE_RETENTION_SECONDS,)
+            )
+            return cursor.rowcount
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> dict:
+        job = dict(row)
+        job["options"] = json.loads(job["options"])
+        if job.get("result"):
+            job["result"] = json.loads(job["result"])
+        return job
@@ -0,0 +1,124 @@
+"""输出文件收尾：faststart、关键帧间隔、分片 MP4、元数据清理、moov 位置校验，以及原子落盘
+
+所有入口生成 MP4 时都应通过这里拼接参数，保证浏览器可以边下边播、快速拖动。
+默认值可通过环境变量调整：
+    OUTPUT_FASTSTART=1        moov 前置（+faststart）
+    OUTPUT_KEYFRAME_SECONDS=2 关键帧间隔（秒），0 表示使用编码器默认值
+    OUTPUT_FRAGMENTED=0       输出分片 MP4（适合流式播放，隐含 moov 前置）
+    OUTPUT_STRIP_METADATA=1   去除源文件的元数据（拍摄地点、设备信息等）
+
+编码过程中只写入 partial_path() 返回的临时文件，成功后由 commit_output() 原子地改名为
+最终文件名，因此进程被杀死时不会留下可被下载的截断文件。
+"""
+import os
+import struct
+import logging
+from typing import Optional
+
+PARTIAL_PREFIX = ".partial-"  # 未完成的输出文件前缀，下载接口和清理逻辑据此识别
+
+logger = logging.getLogger(__name__)
+
+
+def _env_flag(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+OUTPUT_FASTSTART = _env_flag("OUTPUT_FASTSTART", True)
+OUTPUT_KEYFRAME_SECONDS = float(os.environ.get("OUTPUT_KEYFRAME_SECONDS", "2"))
+OUTPUT_FRAGMENTED = _env_flag("OUTPUT_FRAGMENTED", False)
+OUTPUT_STRIP_METADATA = _env_flag("OUTPUT_STRIP_METADATA", True)
+
+
+def keyframe_args(interval: Optional[float] = None) -> list:
+    """按固定时间间隔强制关键帧，与帧率无关"""
+    interval = OUTPUT_KEYFRAME_SECONDS if interval is None else interval
+    if interval <= 0:
+        return []
+    return ["-force_key_frames", f"expr:gte(t,n_forced*{interval:g})"]
+
+
+def metadata_args(strip: Optional[bool] = None) -> list:
+    strip = OUTPUT_STRIP_METADATA if strip is None else strip
+    return ["-map_metadata", "-1", "-map_chapters", "-1"] if strip else []
+
+
+def mp4_container_args(faststart: Optional[bool] = None, fragmented: Optional[bool] = None) -> list:
+    faststart = OUTPUT_FASTSTART if faststart is None else faststart
+    fragmented = OUTPUT_FRAGMENTED if fragmented is None else fragmented
+    if fragmented:
+        return ["-movflags", "+frag_keyframe+empty_moov+default_base_moof"]
+    if faststart:
+        return ["-movflags", "+faststart"]
+    return []
+
+
+def video_output_args(keyframe_interval: Optional[float] = None, faststart: Optional[bool] = None,
+                      fragmented: Optional[bool] = None, strip_metadata: Optional[bool] = None) -> list:
+    """MP4 视频输出的统一收尾参数，放在输出文件名之前"""
+    return (
+        keyframe_args(keyframe_interval)
+        + metadata_args(strip_metadata)
+        + mp4_container_args(faststart, fragmented)
+    )
+
+
+def audio_output_args(strip_metadata: Optional[bool] = None) -> list:
+    """音频输出的统一收尾参数"""
+    return metadata_args(strip_metadata)
+
+
+def moov_before_mdat(path: str) -> Optional[bool]:
+    """扫描 MP4 顶层 box，判断 moov 是否位于第一个 mdat/moof 之前
+
+    返回 None 表示文件不是可识别的 MP4。
+    """
+    try:
+        with open(path, "rb") as f:
+            file_size = os.fstat(f.fileno()).st_size
+            offset = 0
+            while offset + 8 <= file_size:
+                f.seek(offset)
+                size, box_type = struct.unpack(">I4s", f.read(8))
+                if size == 1:
+                    size = struct.unpack(">Q", f.read(8))[0]
+                elif size == 0:
+                    size = file_size - offset
+                if box_type == b"moov":
+                    return True
+                if box_type in (b"mdat", b"moof"):
+                    return False
+                if size < 8:
+                    return None
+                offset += size
+    except (OSError, struct.error):
+        return None
+    return None
+
+
+def verify_faststart(path: str) -> bool:
+    """校验输出可边下边播，不满足时记录警告"""
+    result = moov_before_mdat(path)
+    if result is not True:
+        logger.warning(f"输出文件 moov 不在文件头部，浏览器需下载完整文件才能播放: {path}")
+    return bool(result)
+
+
+def partial_path(path: str) -> str:
+    """输出文件对应的临时文件名（保留扩展名，ffmpeg 据此选择封装格式）"""
+    directory, name = os.path.split(path)
+    return os.path.join(directory, PARTIAL_PREFIX + name)
+
+
+def is_partial(name: str) -> bool:
+    return os.path.basename(name).startswith(PARTIAL_PREFIX)
+
+
+def commit_output(tmp_path: str, path: str):
+    """把已完成的临时文件刷到磁盘后原子地改名为最终文件"""
+    with open(tmp_path, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
@@ -0,0 +1,386 @@
+"""预览服务：关键帧缩略图精灵图和低码率预览片段，按内容哈希缓存
+
+缩略图只解码关键帧（`-skip_frame nokey`），按时长均匀挑选后拼成一张精灵图，前端用
+manifest 中的网格尺寸和时间间隔实现鼠标悬停拖动预览；预览片段是截取中间一段、
+缩到 240p 的低码率 MP4。同一内容只生成一次，缓存总大小超过上限时按最近访问时间淘汰。
+
+    PREVIEW_DIR=/tmp/previews          缓存目录
+    PREVIEW_CACHE_BYTES=209715200      缓存总大小上限
+    PREVIEW_TILE_WIDTH=160             精灵图中每帧的宽度
+    PREVIEW_COLUMNS=5 PREVIEW_ROWS=4   精灵图网格
+    PREVIEW_CLIP_SECONDS=6             预览片段时长
+    PREVIEW_PARALLELISM=1              同时生成预览的数量
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional
+
+try:
+    from ._audio import available_encoders, ffprobe_for
+except ImportError:
+    from _audio import available_encoders, ffprobe_for
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_DIR = os.environ.get("PREVIEW_DIR", "/tmp/previews")
+PREVIEW_CACHE_BYTES = int(os.environ.get("PREVIEW_CACHE_BYTES", str(200 * 1024 * 1024)))
+PREVIEW_TILE_WIDTH = int(os.environ.get("PREVIEW_TILE_WIDTH", "160"))
+PREVIEW_COLUMNS = int(os.environ.get("PREVIEW_COLUMNS", "5"))
+PREVIEW_ROWS = int(os.environ.get("PREVIEW_ROWS", "4"))
+PREVIEW_CLIP_SECONDS = float(os.environ.get("PREVIEW_CLIP_SECONDS", "6"))
+PREVIEW_CLIP_HEIGHT = 240
+PREVIEW_CLIP_MAXRATE = "300k"
+PREVIEW_PARALLELISM = int(os.environ.get("PREVIEW_PARALLELISM", "1"))
+PREVIEW_TIMEOUT = 120  # 单个预览 ffmpeg 进程的超时时间（秒）
+HASH_CHUNK_SIZE = 1024 * 1024
+
+SPRITE_FORMATS = {"webp": ("libwebp", "image/webp"), "jpg": ("mjpeg", "image/jpeg")}
+MANIFEST_NAME = "manifest.json"
+CLIP_NAME = "preview.mp4"
+
+
+def file_digest(path: str) -> str:
+    """分块计算文件的 SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sprite_name(fmt: str) -> str:
+    return f"sprite.{fmt}"
+
+
+def poster_name(fmt: str) -> str:
+    return f"poster.{fmt}"
+
+
+def tile_height(width: Optional[int], height: Optional[int]) -> int:
+    """按源视频宽高比计算每帧高度（偶数），探测失败时按 16:9"""
+    if width and height:
+        value = round(PREVIEW_TILE_WIDTH * height / width)
+    else:
+        value = round(PREVIEW_TILE_WIDTH * 9 / 16)
+    return max(2, value - value % 2)
+
+
+def sprite_command(ffmpeg_cmd: str, input_path: str, output_path: str, duration: Optional[float],
+                   tile_h: int, encoder: str) -> tuple[list, float]:
+    """生成精灵图的命令，返回 (命令, 相邻两帧的时间间隔)
+
+    只解码关键帧；select 按间隔挑选，关键帧稀疏时实际帧数可能少于网格容量。
+    """
+    count = PREVIEW_COLUMNS * PREVIEW_ROWS
+    interval = (duration / count) if duration else 1.0
+    filters = (
+        f"select='isnan(prev_selected_t)+gte(t-prev_selected_t\\,{interval:.3f})',"
+        f"scale={PREVIEW_TILE_WIDTH}:{tile_h}:force_original_aspect_ratio=decrease,"
+        f"pad={PREVIEW_TILE_WIDTH}:{tile_h}:(ow-iw)/2:(oh-ih)/2,"
+        f"tile={PREVIEW_COLUMNS}x{PREVIEW_ROWS}"
+    )
+    cmd = [
+        ffmpeg_cmd, "-y", "-hide_banner",
+        "-skip_frame", "nokey", "-i", input_path,
+        "-an", "-sn", "-vf", filters, "-frames:v", "1",
+        "-c:v", encoder,
+    ]
+    if encoder == "libwebp":
+        cmd += ["-quality", "70"]
+    else:
+        cmd += ["-q:v", "5"]
+    cmd.append(output_path)
+    return cmd, interval
+
+
+def poster_command(ffmpeg_cmd: str, input_path: str, output_path: str, duration: Optional[float],
+                   encoder: str) -> list:
+    """取约 10% 处之后的第一个关键帧作为封面"""
+    cmd = [ffmpeg_cmd, "-y", "-hide_banner"]
+    if duration:
+        cmd += ["-ss", f"{duration * 0.1:.3f}"]
+    cmd += [
+        "-skip_frame", "nokey", "-i", input_path,
+        "-an", "-sn", "-vf", f"scale={PREVIEW_TILE_WIDTH * 2}:-2", "-frames:v", "1",
+        "-c:v", encoder, output_path,
+    ]
+    return cmd
+
+
+def clip_command(ffmpeg_cmd: str, input_path: str, output_path: str, duration: Optional[float]) -> list:
+    """从中间截取一段低码率、无音频的预览片段"""
+    cmd = [ffmpeg_cmd, "-y", "-hide_banner"]
+    if duration and duration > PREVIEW_CLIP_SECONDS:
+        start = max(0.0, min(duration * 0.3, duration - PREVIEW_CLIP_SECONDS))
+        cmd += ["-ss", f"{start:.3f}"]
+    cmd += [
+        "-i", input_path, "-t", f"{PREVIEW_CLIP_SECONDS:g}",
+        "-an", "-sn", "-vf", f"scale=-2:{PREVIEW_CLIP_HEIGHT}",
+        "-c:v", "libx264", "-preset", "veryfast", "-crf", "35",
+        "-maxrate", PREVIEW_CLIP_MAXRATE, "-bufsize", "600k",
+        "-map_metadata", "-1", "-movflags", "+faststart",
+        output_path,
+    ]
+    return cmd
+
+
+async def probe_video(ffmpeg_cmd: str, input_path: str) -> dict:
+    """读取第一条视频流的宽高和时长，失败时返回空字典"""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            ffprobe_for(ffmpeg_cmd), "-v", "error",
+            "-select_streams", "v:0",
+            "-show_entries", "stream=width,height:format=duration",
+            "-of", "json",
+            input_path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, _ = await asyncio.wait_for(process.communicate(), timeout=30)
+        data = json.loads(stdout.decode() or "{}")
+    except (FileNotFoundError, ValueError, asyncio.TimeoutError):
+        return {}
+    stream = (data.get("streams") or [{}])[0]
+    try:
+        duration = float(data.get("format", {}).get("duration"))
+    except (TypeError, ValueError):
+        duration = None
+    return {"width": stream.get("width"), "height": stream.get("height"), "duration": duration}
+
+
+class PreviewCache:
+    """按内容哈希组织的预览缓存目录，每个哈希一个子目录"""
+
+    def __init__(self, root: str = PREVIEW_DIR, max_bytes: int = PREVIEW_CACHE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def entry_dir(self, digest: str) -> str:
+        return os.path.join(self.root, digest)
+
+    def staging_dir(self, digest: str) -> str:
+        """生成中的预览写入临时目录，完成后整体改名，读取方不会看到半成品"""
+        return os.path.join(self.root, f".partial-{digest}-{os.getpid()}")
+
+    def load(self, digest: str) -> Optional[dict]:
+        """读取已缓存的 manifest，并刷新访问时间供淘汰使用"""
+        path = os.path.join(self.entry_dir(digest), MANIFEST_NAME)
+        try:
+            with open(path, "r") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        now = time.time()
+        try:
+            os.utime(self.entry_dir(digest), (now, now))
+        except OSError:
+            pass
+        return manifest
+
+    def has(self, digest: str) -> bool:
+        return os.path.isfile(os.path.join(self.entry_dir(digest), MANIFEST_NAME))
+
+    def asset_path(self, digest: str, name: str) -> Optional[str]:
+        path = os.path.join(self.entry_dir(digest), name)
+        return path if os.path.isfile(path) else None
+
+    def commit(self, digest: str, staging: str, manifest: dict):
+        with open(os.path.join(staging, MANIFEST_NAME), "w") as f:
+            json.dump(manifest, f)
+        target = self.entry_dir(digest)
+        try:
+            os.rename(staging, target)
+        except OSError:
+            # 其他 worker 已经生成了同一内容的预览
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def evict(self) -> int:
+        """总大小超过上限时，从最久未访问的条目开始删除，返回删除的条目数"""
+        if not os.path.isdir(self.root):
+            return 0
+        entries = []
+        total = 0
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if not os.path.isdir(path):
+                continue
+            if name.startswith(".partial-"):
+                # 生成过程中崩溃遗留的临时目录
+                if os.path.getmtime(path) < time.time() - PREVIEW_TIMEOUT * 3:
+                    shutil.rmtree(path, ignore_errors=True)
+                continue
+            size = sum(
+                os.path.getsize(os.path.join(path, f))
+                for f in os.listdir(path)
+                if os.path.isfile(os.path.join(path, f))
+            )
+            entries.append((os.path.getmtime(path), size, path))
+            total += size
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+        if removed:
+            logger.info(f"淘汰预览缓存 {removed} 项，剩余 {total // 1024}KB")
+        return removed
+
+
+preview_cache = PreviewCache()
+
+Runner = Callable[[list], Awaitable[tuple]]
+Admission = Callable[[], Awaitable[Optional[Callable[[asyncio.Future], None]]]]
+_building: Dict[str, asyncio.Future] = {}  # 缓存键 -> 正在生成的预览，相同内容的并发请求共享
+_build_slots: Optional[asyncio.Semaphore] = None
+_admission: Optional[asyncio.Lock] = None  # 串行化"检查是否需要生成 + 准入 + 启动"，同一内容只准入一次
+
+
+async def _run(cmd: list) -> tuple[int, bytes]:
+    """默认的 ffmpeg 执行方式：带超时，返回 (returncode, stderr)"""
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        _, stderr = await asyncio.wait_for(process.communicate(), timeout=PREVIEW_TIMEOUT)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.communicate()
+        raise
+    return process.returncode, stderr or b""
+
+
+def _succeeded(outcome, path: str) -> bool:
+    return not isinstance(outcome, BaseException) and outcome[0] == 0 and os.path.isfile(path)
+
+
+async def _build(ffmpeg_cmd: str, input_path: str, key: str, fmt: str, cache: PreviewCache,
+                 runner: Runner) -> dict:
+    global _build_slots
+    if _build_slots is None:
+        # 在事件循环内创建，避免绑定到导入时的循环
+        _build_slots = asyncio.Semaphore(PREVIEW_PARALLELISM)
+    async with _build_slots:
+        info = await probe_video(ffmpeg_cmd, input_path)
+        staging = cache.staging_dir(key)
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+
+        encoder = SPRITE_FORMATS[fmt][0]
+        tile_h = tile_height(info.get("width"), info.get("height"))
+        sprite_path = os.path.join(staging, sprite_name(fmt))
+        poster_path = os.path.join(staging, poster_name(fmt))
+        clip_path = os.path.join(staging, CLIP_NAME)
+        sprite_cmd, interval = sprite_command(ffmpeg_cmd, input_path, sprite_path, info.get("duration"),
+                                              tile_h, encoder)
+        sprite, poster, clip = await asyncio.gather(
+            runner(sprite_cmd),
+            runner(poster_command(ffmpeg_cmd, input_path, poster_path, info.get("duration"), encoder)),
+            runner(clip_command(ffmpeg_cmd, input_path, clip_path, info.get("duration"))),
+            return_exceptions=True
+        )
+        if not _succeeded(sprite, sprite_path):
+            shutil.rmtree(staging, ignore_errors=True)
+            detail = sprite if isinstance(sprite, BaseException) else sprite[1].decode(errors="replace")[-500:]
+            logger.error(f"生成缩略图失败: {detail}")
+            raise RuntimeError("生成缩略图失败")
+        for name, outcome, path in (("poster", poster, poster_path), ("clip", clip, clip_path)):
+            if not _succeeded(outcome, path):
+                logger.warning(f"生成预览 {name} 失败: {input_path}")
+
+        manifest = {
+            "duration": info.get("duration"),
+            "width": info.get("width"),
+            "height": info.get("height"),
+            "sprite": {
+                "file": sprite_name(fmt),
+                "format": fmt,
+                "columns": PREVIEW_COLUMNS,
+                "rows": PREVIEW_ROWS,
+                "tile_width": PREVIEW_TILE_WIDTH,
+                "tile_height": tile_h,
+                "interval": round(interval, 3),
+            },
+            "poster": poster_name(fmt) if _succeeded(poster, poster_path) else None,
+            "clip": CLIP_NAME if _succeeded(clip, clip_path) else None,
+        }
+        cache.commit(key, staging, manifest)
+    await asyncio.get_running_loop().run_in_executor(None, cache.evict)
+    return manifest
+
+
+async def preview_key(ffmpeg_cmd: str, digest: str, fmt: str = "webp") -> str:
+    """缓存键（内容哈希 + 图片格式）；本地 ffmpeg 不支持 WebP 时回退到 JPEG"""
+    if fmt == "webp" and "libwebp" not in await available_encoders(ffmpeg_cmd):
+        fmt = "jpg"
+    return f"{digest}-{fmt}"
+
+
+async def get_preview(ffmpeg_cmd: str, input_path: str, digest: str, fmt: str = "webp",
+                      cache: PreviewCache = preview_cache, runner: Optional[Runner] = None,
+                      admit: Optional[Admission] = None) -> tuple[str, dict]:
+    """返回 (缓存键, manifest)；未缓存时生成，相同内容的并发请求只生成一次
+
+    admit 只在本次请求需要启动新的生成时调用，可以抛出异常拒绝请求；它返回的回调挂在
+    生成任务上，生成结束时调用——发起请求的客户端中途断开也不影响，生成期间占用的
+    并发名额、配额应在这里释放。
+    """
+    global _admission
+    key = await preview_key(ffmpeg_cmd, digest, fmt)
+    fmt = key.rsplit("-", 1)[1]
+    manifest = cache.load(key)
+    if manifest is not None:
+        return key, manifest
+    if key not in _building:
+        if _admission is None:
+            _admission = asyncio.Lock()
+        async with _admission:
+            # 等待期间其他请求可能已经开始或完成了同一内容的生成
+            manifest = None if key in _building else cache.load(key)
+            if manifest is not None:
+                return key, manifest
+            if key not in _building:
+                on_done = await admit() if admit else None
+                build = asyncio.ensure_future(
+                    _build(ffmpeg_cmd, input_path, key, fmt, cache, runner or _run)
+                )
+                _building[key] = build
+                build.add_done_callback(lambda _: _building.pop(key, None))
+                if on_done:
+                    build.add_done_callback(on_done)
+    # shield：某个请求被取消不影响生成本身和其他等待同一预览的请求
+    return key, await asyncio.shield(_building[key])
+
+
+def preview_response(key: str, manifest: dict, prefix: str = "/preview/assets") -> dict:
+    """把 manifest 中的文件名转换为可访问的地址"""
+    def url(name: Optional[str]) -> Optional[str]:
+        return f"{prefix}/{key}/{name}" if name else None
+
+    sprite = dict(manifest["sprite"])
+    sprite["url"] = url(sprite.pop("file"))
+    return {
+        "id": key,
+        "duration": manifest.get("duration"),
+        "width": manifest.get("width"),
+        "height": manifest.get("height"),
+        "sprite": sprite,
+        "poster": url(manifest.get("poster")),
+        "clip": url(manifest.get("clip")),
+    }
+
+
+def asset_media_type(name: str) -> str:
+    if name.endswith(".mp4"):
+        return "video/mp4"
+    if name.endswith(".json"):
+        return "application/json"
+    return SPRITE_FORMATS["webp" if name.endswith(".webp") else "jpg"][1]
@@ -0,0 +1,35 @@
+"""惰性创建的 SQLite 存储：任务历史、任务日志和跨进程协调器共用的连接逻辑
+
+数据库文件、所在目录和表结构都在第一次连接时才创建，避免拖慢冷启动。
+连接使用 WAL 模式并关闭自动事务（isolation_level=None），需要原子性的操作由调用方
+显式执行 BEGIN IMMEDIATE。
+"""
+import os
+import sqlite3
+from contextlib import contextmanager
+
+
+class LazySQLite:
+    """子类实现 _create_schema，通过 `with self._connect() as conn` 访问数据库"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._ready = False
+
+    def _create_schema(self, conn: sqlite3.Connection):
+        raise NotImplementedError
+
+    @contextmanager
+    def _connect(self):
+        if not self._ready:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            if not self._ready:
+                conn.execute("PRAGMA journal_mode=WAL")
+                self._create_schema(conn)
+                self._ready = True
+            yield conn
+        finally:
+            conn.close()
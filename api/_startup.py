@@ -0,0 +1,64 @@
+"""冷启动耗时记录：模块导入、各项惰性初始化以及首个请求的耗时
+
+应用在导入阶段只做最少的工作，目录、数据库、ffmpeg 探测等都推迟到第一次使用时，
+并在这里记录各阶段耗时，通过 /startup-report 查看。
+"""
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+PROCESS_STARTED = time.perf_counter()  # 入口模块会用自己的导入起点覆盖，见 set_process_started
+
+_phases: Dict[str, float] = {}
+_first_request_ms: Optional[float] = None
+
+
+def set_process_started(started: float):
+    """以入口模块第一行的 perf_counter 时间戳作为起点，使首个请求的耗时包含导入 FastAPI 等依赖的时间"""
+    global PROCESS_STARTED
+    PROCESS_STARTED = started
+
+
+def record(name: str, started: float):
+    """记录从 started（perf_counter 时间戳）到现在的耗时"""
+    _phases[name] = round((time.perf_counter() - started) * 1000, 2)
+
+
+@contextmanager
+def timed(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, started)
+
+
+def mark_first_request():
+    """首个请求完成时调用，记录从进程导入到首个响应的总耗时"""
+    global _first_request_ms
+    if _first_request_ms is None:
+        _first_request_ms = round((time.perf_counter() - PROCESS_STARTED) * 1000, 2)
+
+
+def report() -> dict:
+    return {
+        "phases_ms": dict(_phases),
+        "first_request_ms": _first_request_ms,
+        "uptime_seconds": round(time.perf_counter() - PROCESS_STARTED, 1),
+    }
+
+
+class FirstRequestMiddleware:
+    """纯 ASGI 中间件，首个 HTTP 请求处理完后调用 mark_first_request
+
+    不使用 @app.middleware("http")：BaseHTTPMiddleware 会替换 receive 通道，
+    接口里的 request.is_disconnected() 因此收不到客户端断开，断开即取消任务会失效。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        await self.app(scope, receive, send)
+        if scope["type"] == "http":
+            mark_first_request()
@@ -0,0 +1,139 @@
+"""常驻编码进程池：用 PyAV 在进程内编码短音频，免去每个文件启动 ffmpeg 的开销
+
+ffmpeg 命令行每次只能处理一个任务，无法常驻接收新任务。对于大量短音频，进程启动和编码器
+初始化占了大部分耗时，因此在安装了 PyAV（`pip install av`）时，短音频交给一组常驻的
+worker 进程处理：worker 启动时加载 libav 并预热编码器，之后通过进程池的管道接收任务。
+未安装 PyAV、需要响度标准化或音频较长时，调用方应回退到 ffmpeg 命令行。
+进程池中的任务无法中途终止，也不写 -progress 文件，因此只适合不需要取消和进度的批量接口。
+
+    WARM_WORKERS=2          常驻 worker 数量，0 表示禁用
+    WARM_MAX_SECONDS=120    交给常驻 worker 处理的最大音频时长（秒）
+    WARM_TIMEOUT=60         单个任务的超时时间（秒），超时后重建进程池
+"""
+import os
+import asyncio
+import logging
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# 只检测 PyAV 是否安装而不导入，避免在主进程冷启动时加载 libav
+PYAV_AVAILABLE = importlib.util.find_spec("av") is not None
+
+WARM_WORKERS = int(os.environ.get("WARM_WORKERS", str(min(2, os.cpu_count() or 1))))
+WARM_MAX_SECONDS = float(os.environ.get("WARM_MAX_SECONDS", "120"))
+WARM_TIMEOUT = float(os.environ.get("WARM_TIMEOUT", "60"))
+
+# 预热的编码器；libfdk_aac 的 HE 配置不经过 PyAV
+WARM_ENCODERS = ("libopus", "aac", "libmp3lame")
+
+
+def _warm_up():
+    """worker 初始化：导入 libav 并打开一次各编码器，使共享库和编码表常驻内存"""
+    import av
+    for name in WARM_ENCODERS:
+        try:
+            codec = av.codec.Codec(name, "w")
+            context = av.CodecContext.create(codec)
+            context.sample_rate = 48000
+            context.layout = "stereo"
+            context.format = codec.audio_formats[0]
+            context.bit_rate = 64000
+            context.open()
+        except Exception:
+            pass
+
+
+def _transcode_audio(input_path: str, output_path: str, encoder: str, bitrate: int,
+                     channels: int, sample_rate: int, options: dict) -> None:
+    """在 worker 进程中完成一次音频转码（解码 -> 重采样 -> 编码 -> 封装）"""
+    import av
+    layout = "mono" if channels == 1 else "stereo"
+    container_options = {"movflags": "+faststart"} if output_path.endswith(".m4a") else {}
+    with av.open(input_path) as src, av.open(output_path, "w", options=container_options) as dst:
+        in_stream = src.streams.audio[0]
+        out_stream = dst.add_stream(encoder, rate=sample_rate)
+        out_stream.codec_context.layout = layout
+        out_stream.codec_context.bit_rate = bitrate * 1000
+        out_stream.codec_context.options = dict(options)
+        resampler = av.AudioResampler(
+            format=out_stream.codec_context.format.name, layout=layout, rate=sample_rate
+        )
+        for frame in src.decode(in_stream):
+            frame.pts = None
+            for resampled in resampler.resample(frame):
+                for packet in out_stream.encode(resampled):
+                    dst.mux(packet)
+        for resampled in resampler.resample(None):
+            for packet in out_stream.encode(resampled):
+                dst.mux(packet)
+        for packet in out_stream.encode(None):
+            dst.mux(packet)
+
+
+class WarmEncoderPool:
+    """惰性创建的常驻 worker 进程池"""
+
+    def __init__(self, workers: int = WARM_WORKERS):
+        self.workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def enabled(self) -> bool:
+        return PYAV_AVAILABLE and self.workers > 0
+
+    def accepts(self, profile: dict, loudnorm: bool = False) -> bool:
+        """短音频、无滤镜且编码器可由 PyAV 处理时才使用常驻 worker"""
+        if not self.enabled or loudnorm:
+            return False
+        if profile.get("encoder") not in WARM_ENCODERS:
+            return False
+        duration = profile.get("duration")
+        return duration is not None and duration <= WARM_MAX_SECONDS
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            logger.info(f"启动常驻编码进程池: {self.workers} 个 worker")
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_warm_up)
+        return self._executor
+
+    async def transcode_audio(self, input_path: str, output_path: str, profile: dict,
+                              timeout: float = WARM_TIMEOUT) -> None:
+        """超时抛出 asyncio.TimeoutError，卡住的 worker 会被终止，调用方应回退到 ffmpeg"""
+        loop = asyncio.get_running_loop()
+        options = {}
+        if profile["encoder"] == "libopus":
+            options["application"] = "voip" if profile["content"] == "speech" else "audio"
+        executor = self._get_executor()
+        try:
+            await asyncio.wait_for(loop.run_in_executor(
+                executor, _transcode_audio, input_path, output_path,
+                profile["encoder"], profile["bitrate"], profile["channels"], profile["sample_rate"], options
+            ), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"常驻 worker 编码超时（{timeout:g} 秒），重建进程池: {input_path}")
+            self.recycle(executor)
+            raise
+
+    def recycle(self, executor: ProcessPoolExecutor):
+        """终止进程池中的 worker：进程池中的任务无法单独取消，只能连同进程一起结束
+
+        同一进程池中其他进行中的任务会以 BrokenProcessPool 失败并各自回退到 ffmpeg；
+        下一个任务到来时重新创建进程池。
+        """
+        if self._executor is executor:
+            self._executor = None
+        # ProcessPoolExecutor 没有公开终止 worker 的接口
+        for process in list(getattr(executor, "_processes", {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+warm_pool = WarmEncoderPool()
@@ -1,4 +1,8 @@
+import time
+_import_started = time.perf_counter()  # 冷启动计时起点
+
 import os
+import re
 import shutil
 import tempfile
 import asyncio
@@ -12,12 +16,34 @@ from fastapi import FastAPI, File, UploadFile, HTTPException, Query, BackgroundT
 from fastapi.responses import FileResponse, JSONResponse, RedirectResponse, HTMLResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
-from fastapi.security.utils import get_authorization_scheme_param
 import uuid
 
+try:
+    from . import _startup as startup_profile
+    from ._coordination import coordinated, create_coordinator, wait_for_slot
+    from ._output import (audio_output_args, commit_output, is_partial, partial_path,
+                          video_output_args, verify_faststart)
+    from ._audio import (AUDIO_CONTENT_TYPES, AUDIO_FORMATS, audio_encode_args,
+                         build_batch_command, plan_audio)
+    from ._workers import warm_pool
+    from ._preview import (SPRITE_FORMATS, asset_media_type, file_digest, get_preview,
+                           preview_cache, preview_response)
+except ImportError:
+    import _startup as startup_profile
+    from _coordination import coordinated, create_coordinator, wait_for_slot
+    from _output import (audio_output_args, commit_output, is_partial, partial_path,
+                         video_output_args, verify_faststart)
+    from _audio import (AUDIO_CONTENT_TYPES, AUDIO_FORMATS, audio_encode_args,
+                        build_batch_command, plan_audio)
+    from _workers import warm_pool
+    from _preview import (SPRITE_FORMATS, asset_media_type, file_digest, get_preview,
+                          preview_cache, preview_response)
+
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+startup_profile.set_process_started(_import_started)
+startup_profile.record("imports", _import_started)
 
 app = FastAPI(title="Video Compression Tool", version="1.0.0")
 
@@ -44,6 +70,9 @@ app.add_middleware(
     allowed_hosts=["*"]  # 在生产环境中应该限制为特定域名
 )
 
+# 记录首个请求耗时（纯 ASGI 中间件，不影响断开检测）
+app.add_middleware(startup_profile.FirstRequestMiddleware)
+
 # 全局配置
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
 MAX_FILES_PER_REQUEST = 5
@@ -55,13 +84,18 @@ TEMP_DIR = tempfile.gettempdir()
 UPLOAD_DIR = os.path.join(TEMP_DIR, "video_compress_uploads")
 OUTPUT_DIR = os.path.join(TEMP_DIR, "video_compress_outputs")
 
-# 确保目录存在
-os.makedirs(UPLOAD_DIR, exist_ok=True)
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+_dirs_ready = False  # 目录在第一次上传时才创建
+
+# FFmpeg 可用性缓存，避免每次健康检查都启动 ffmpeg
+FFMPEG_CHECK_TTL = 300  # 秒
+_ffmpeg_check = None  # (检查时间, 是否可用)
+
+# 临时文件清理不在启动路径上执行，按间隔在后台运行
+CLEANUP_INTERVAL = 600  # 秒
+_last_cleanup = 0.0
 
-# 并发控制
-current_tasks = 0
-task_semaphore = asyncio.Semaphore(MAX_CONCURRENT_TASKS)
+# 并发控制（设置 SHARED_STATE_DB 后由所有 worker 共享）
+job_coordinator = create_coordinator()
 
 # 文件类型检查
 SUPPORTED_VIDEO_FORMATS = {'.mp4', '.mov', '.avi', '.mkv', '.webm', '.flv'}
@@ -80,16 +114,33 @@ def validate_filename(filename: str) -> bool:
     """验证文件名安全性"""
     if not filename or '..' in filename or '/' in filename or '\\' in filename:
         return False
-    return True
+    # 尚未完成的输出文件不可下载
+    return not is_partial(filename)
+
+def ensure_dirs() -> None:
+    """惰性创建上传与输出目录"""
+    global _dirs_ready
+    if not _dirs_ready:
+        with startup_profile.timed("ensure_dirs"):
+            os.makedirs(UPLOAD_DIR, exist_ok=True)
+            os.makedirs(OUTPUT_DIR, exist_ok=True)
+        _dirs_ready = True
 
 def check_ffmpeg_available() -> bool:
-    """检查 FFmpeg 是否可用"""
-    try:
-        result = subprocess.run(['ffmpeg', '-version'], 
-                              capture_output=True, text=True, timeout=10)
-        return result.returncode == 0
-    except (subprocess.TimeoutExpired, FileNotFoundError, subprocess.SubprocessError):
-        return False
+    """检查 FFmpeg 是否可用（结果缓存 FFMPEG_CHECK_TTL 秒）"""
+    global _ffmpeg_check
+    now = time.monotonic()
+    if _ffmpeg_check and now - _ffmpeg_check[0] < FFMPEG_CHECK_TTL:
+        return _ffmpeg_check[1]
+    with startup_profile.timed("ffmpeg_probe"):
+        try:
+            result = subprocess.run(['ffmpeg', '-version'], 
+                                  capture_output=True, text=True, timeout=10)
+            available = result.returncode == 0
+        except (subprocess.TimeoutExpired, FileNotFoundError, subprocess.SubprocessError):
+            available = False
+    _ffmpeg_check = (now, available)
+    return available
 
 async def compress_video_async(input_path: str, output_path: str, progress_callback=None) -> None:
     """异步压缩视频"""
@@ -98,7 +149,7 @@ async def compress_video_async(input_path: str, output_path: str, progress_callb
         "-vf", "scale=-2:480",
         "-c:v", "libx264", "-preset", "veryfast", "-crf", "32",
         "-c:a", "aac", "-b:a", "64k",
-        "-movflags", "+faststart",  # 优化 web 播放
+        *video_output_args(),  # faststart、关键帧间隔、元数据清理
         output_path
     ]
     
@@ -121,12 +172,24 @@ async def compress_video_async(input_path: str, output_path: str, progress_callb
         logger.error(f"Video compression failed: {str(e)}")
         raise HTTPException(status_code=500, detail=f"视频压缩失败: {str(e)}")
 
-async def compress_audio_async(input_path: str, output_path: str, progress_callback=None) -> None:
-    """异步压缩音频"""
+async def compress_audio_async(input_path: str, output_path: str, progress_callback=None,
+                               profile: Optional[dict] = None, loudnorm: bool = False) -> None:
+    """异步压缩音频（输出扩展名需与 profile["ext"] 一致）"""
+    if profile is None:
+        profile = await plan_audio("ffmpeg", input_path)
+    
+    # 短音频优先交给常驻 worker，失败时回退到 ffmpeg 命令行
+    if warm_pool.accepts(profile, loudnorm):
+        try:
+            await warm_pool.transcode_audio(input_path, output_path, profile)
+            return
+        except Exception as e:
+            logger.warning(f"Warm worker failed, falling back to ffmpeg: {e}")
+    
     cmd = [
         "ffmpeg", "-y", "-i", input_path,
-        "-vn", "-ar", "44100", "-ac", "2", "-b:a", "64k",
-        "-acodec", "aac",
+        *audio_encode_args(profile, loudnorm),
+        *audio_output_args(),
         output_path
     ]
     
@@ -149,6 +212,74 @@ async def compress_audio_async(input_path: str, output_path: str, progress_callb
         logger.error(f"Audio compression failed: {str(e)}")
         raise HTTPException(status_code=500, detail=f"音频压缩失败: {str(e)}")
 
+async def compress_audio_batch_async(jobs: List[Dict], loudnorm: bool = False) -> None:
+    """用一个 ffmpeg 进程压缩多个音频文件，省去每个文件的进程启动和编码器初始化开销"""
+    cmd = build_batch_command("ffmpeg", jobs, loudnorm, audio_output_args())
+    
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await process.communicate()
+    
+    if process.returncode != 0:
+        error_msg = stderr.decode() if stderr else "Unknown FFmpeg error"
+        logger.error(f"FFmpeg batch error: {error_msg}")
+        raise subprocess.CalledProcessError(process.returncode, cmd, stderr)
+
+async def process_audio_jobs(jobs: List[Dict], loudnorm: bool = False) -> None:
+    """压缩排队的音频并填充结果；合并处理失败时逐个重试以定位失败的文件
+
+    可由常驻 worker 处理的短音频并行提交，其余音频合并为一个 ffmpeg 进程。
+    """
+    pending = [job for job in jobs if warm_pool.accepts(job["profile"], loudnorm)]
+    batch_jobs = [job for job in jobs if job not in pending]
+    if len(batch_jobs) > 1:
+        try:
+            await compress_audio_batch_async(batch_jobs, loudnorm)
+        except Exception as e:
+            logger.warning(f"Batch audio compression failed, retrying individually: {e}")
+            pending += batch_jobs
+    else:
+        pending += batch_jobs
+    
+    async def compress_one(job: Dict) -> None:
+        try:
+            await compress_audio_async(job["input_path"], job["output_path"],
+                                       profile=job["profile"], loudnorm=loudnorm)
+        except Exception as e:
+            logger.error(f"Processing failed for {job['result']['original_filename']}: {str(e)}")
+            job["result"].update({"status": "failed", "error": str(e)})
+    
+    await asyncio.gather(*(compress_one(job) for job in pending))
+    
+    for job in jobs:
+        if job["result"].get("status") == "failed":
+            if os.path.exists(job["output_path"]):
+                os.remove(job["output_path"])
+            continue
+        commit_output(job["output_path"], job["final_path"])
+        compressed_size = os.path.getsize(job["final_path"])
+        compression_ratio = (1 - compressed_size / job["original_size"]) * 100
+        job["result"].update({
+            "download_url": f"/download/{os.path.basename(job['final_path'])}",
+            "original_size": job["original_size"],
+            "compressed_size": compressed_size,
+            "compression_ratio": round(compression_ratio, 2),
+            "audio_codec": job["profile"]["codec"],
+            "audio_content": job["profile"]["content"],
+            "status": "success"
+        })
+
+def remove_upload(input_path: str) -> None:
+    """删除已处理的上传文件"""
+    if os.path.exists(input_path):
+        try:
+            os.remove(input_path)
+        except Exception as e:
+            logger.warning(f"Failed to remove {input_path}: {e}")
+
 def cleanup_old_files():
     """清理超过生命周期的临时文件"""
     try:
@@ -167,14 +298,30 @@ def cleanup_old_files():
                             logger.info(f"Cleaned up old file: {file_path}")
                         except Exception as e:
                             logger.warning(f"Failed to clean up {file_path}: {e}")
+        preview_cache.evict()
     except Exception as e:
         logger.error(f"Cleanup failed: {e}")
 
+def maybe_cleanup_old_files() -> None:
+    """距上次清理超过 CLEANUP_INTERVAL 时才扫描临时目录"""
+    global _last_cleanup
+    now = time.monotonic()
+    if _last_cleanup and now - _last_cleanup < CLEANUP_INTERVAL:
+        return
+    _last_cleanup = now
+    with startup_profile.timed("cleanup"):
+        cleanup_old_files()
+
 @app.on_event("startup")
 async def startup_event():
-    """应用启动时的初始化"""
+    """应用启动时的初始化：不做阻塞工作，临时文件在后台清理"""
     logger.info("Starting Video Compression API")
-    cleanup_old_files()
+    asyncio.get_running_loop().run_in_executor(None, maybe_cleanup_old_files)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """关闭常驻编码进程池"""
+    warm_pool.shutdown()
 
 @app.get("/")
 async def read_root():
@@ -193,8 +340,10 @@ async def read_root():
         <ul>
             <li>POST /upload - 上传并压缩文件</li>
             <li>GET /download/{filename} - 下载压缩文件</li>
+            <li>GET /preview/{filename} - 视频缩略图精灵图与预览片段</li>
             <li>GET /health - 健康检查</li>
             <li>GET /ffmpeg-check - FFmpeg 可用性检查</li>
+            <li>GET /startup-report - 冷启动耗时</li>
         </ul>
     </body>
     </html>
@@ -223,11 +372,12 @@ async def ffmpeg_availability():
 async def upload_and_compress(
     background_tasks: BackgroundTasks,
     files: List[UploadFile] = File(...),
-    task_id: Optional[str] = Query(None)
+    task_id: Optional[str] = Query(None),
+    audio_format: str = Query("auto"),
+    audio_content: Optional[str] = Query(None),
+    loudnorm: bool = Query(False)
 ):
     """上传并压缩文件"""
-    global current_tasks
-    
     # 检查 FFmpeg 可用性
     if not check_ffmpeg_available():
         raise HTTPException(
@@ -242,6 +392,11 @@ async def upload_and_compress(
             detail=f"最多只能同时上传 {MAX_FILES_PER_REQUEST} 个文件"
         )
     
+    if audio_format not in AUDIO_FORMATS:
+        raise HTTPException(status_code=400, detail=f"不支持的音频格式: {audio_format}")
+    if audio_content is not None and audio_content not in AUDIO_CONTENT_TYPES:
+        raise HTTPException(status_code=400, detail=f"不支持的音频内容类型: {audio_content}")
+    
     # 验证文件
     for file in files:
         if not file.filename or not validate_filename(file.filename):
@@ -253,83 +408,114 @@ async def upload_and_compress(
                 detail=f"不支持的文件格式: {file.filename}. 支持的格式: {', '.join(SUPPORTED_VIDEO_FORMATS | SUPPORTED_AUDIO_FORMATS)}"
             )
     
-    # 并发控制
-    async with task_semaphore:
-        current_tasks += 1
+    ensure_dirs()
+    
+    # 并发控制：等待全局名额（每个请求占用一个）
+    request_id = str(uuid.uuid4())
+    await wait_for_slot(job_coordinator, request_id, "batch", MAX_CONCURRENT_TASKS)
+    try:
+        results = []
+        audio_jobs = []  # 音频统一在循环结束后合并处理
+        
         try:
-            results = []
-            
-            for file in files:
-                file_id = task_id or str(uuid.uuid4())
+            for index, file in enumerate(files):
+                if task_id:
+                    file_id = task_id if len(files) == 1 else f"{task_id}_{index}"
+                else:
+                    file_id = str(uuid.uuid4())
                 file_ext = Path(file.filename).suffix.lower()
-                
+            
                 # 检查文件大小
                 content = await file.read()
                 if len(content) > MAX_FILE_SIZE:
-                    current_tasks -= 1
                     raise HTTPException(
                         status_code=413, 
                         detail=f"文件 {file.filename} 超过最大限制 {MAX_FILE_SIZE//1024//1024}MB"
                     )
-                
+            
                 # 保存上传文件
                 input_path = os.path.join(UPLOAD_DIR, f"{file_id}{file_ext}")
+                queued = False
+                partial_output = None
                 try:
                     with open(input_path, "wb") as f:
                         f.write(content)
-                        
-                    original_size = len(content)
-                    
-                    # 根据文件类型选择压缩方式
-                    if is_video(file.filename):
-                        output_filename = f"{file_id}_compressed.mp4"
-                        output_path = os.path.join(OUTPUT_DIR, output_filename)
-                        await compress_video_async(input_path, output_path)
-                    else:  # 音频文件
-                        output_filename = f"{file_id}_compressed.mp3"
-                        output_path = os.path.join(OUTPUT_DIR, output_filename)
-                        await compress_audio_async(input_path, output_path)
                     
+                    original_size = len(content)
+                
+                    # 音频文件：探测后排队，稍后用一个 ffmpeg 进程统一处理
+                    if not is_video(file.filename):
+                        profile = await plan_audio("ffmpeg", input_path, audio_format, audio_content)
+                        result = {"original_filename": file.filename}
+                        results.append(result)
+                        final_path = os.path.join(OUTPUT_DIR, f"{file_id}_compressed{profile['ext']}")
+                        audio_jobs.append({
+                            "input_path": input_path,
+                            "output_path": partial_path(final_path),
+                            "final_path": final_path,
+                            "original_size": original_size,
+                            "profile": profile,
+                            "result": result
+                        })
+                        queued = True
+                        continue
+                
+                    output_filename = f"{file_id}_compressed.mp4"
+                    output_path = os.path.join(OUTPUT_DIR, output_filename)
+                    # 先写入临时文件，完成后再原子改名，避免下载到截断的文件
+                    partial_output = partial_path(output_path)
+                    await compress_video_async(input_path, partial_output)
+                    commit_output(partial_output, output_path)
+                    verify_faststart(output_path)
+                
                     # 获取压缩后文件大小
                     compressed_size = os.path.getsize(output_path)
                     compression_ratio = (1 - compressed_size / original_size) * 100
-                    
+                
                     results.append({
                         "original_filename": file.filename,
                         "download_url": f"/download/{output_filename}",
+                        "preview_url": f"/preview/{output_filename}",
                         "original_size": original_size,
                         "compressed_size": compressed_size,
                         "compression_ratio": round(compression_ratio, 2),
                         "status": "success"
                     })
-                    
+                
                 except Exception as e:
                     logger.error(f"Processing failed for {file.filename}: {str(e)}")
+                    # 删除编码失败留下的临时输出
+                    if partial_output and os.path.exists(partial_output):
+                        os.remove(partial_output)
                     results.append({
                         "original_filename": file.filename,
                         "status": "failed",
                         "error": str(e)
                     })
                 finally:
-                    # 清理上传文件
-                    if os.path.exists(input_path):
-                        try:
-                            os.remove(input_path)
-                        except Exception as e:
-                            logger.warning(f"Failed to remove {input_path}: {e}")
-            
-            # 添加清理任务
-            background_tasks.add_task(cleanup_old_files)
-            
-            return JSONResponse({
-                "results": results,
-                "total_files": len(files),
-                "successful": len([r for r in results if r.get("status") == "success"]),
-                "failed": len([r for r in results if r.get("status") == "failed"])
-            })
+                    # 清理上传文件（排队中的音频在处理后再清理）
+                    if not queued:
+                        remove_upload(input_path)
             
+            if audio_jobs:
+                await process_audio_jobs(audio_jobs, loudnorm)
         finally:
-            current_tasks -= 1
+            # 循环中途出错（如后面的文件超过大小限制返回 413）时，已排队的音频同样要清理
+            for job in audio_jobs:
+                remove_upload(job["input_path"])
+        
+        # 添加清理任务
+        background_tasks.add_task(maybe_cleanup_old_files)
+        
+        return JSONResponse({
+            "results": results,
+            "total_files": len(files),
+            "successful": len([r for r in results if r.get("status") == "success"]),
+            "failed": len([r for r in results if r.get("status") == "failed"])
+        })
+        
+    finally:
+        await coordinated(job_coordinator, "release", request_id)
 
 @app.get("/download/{filename}")
 async def download_file(filename: str):
@@ -352,18 +538,67 @@ async def download_file(filename: str):
         }
     )
 
+@app.get("/preview/{filename}")
+async def preview_file(filename: str, format: str = Query("webp")):
+    """压缩结果的缩略图精灵图、封面和预览片段，按内容哈希缓存"""
+    if not validate_filename(filename) or not is_video(filename):
+        raise HTTPException(status_code=400, detail="无效的文件名")
+    if format not in SPRITE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"不支持的图片格式: {format}")
+    
+    file_path = os.path.join(OUTPUT_DIR, filename)
+    if not os.path.exists(file_path):
+        raise HTTPException(status_code=404, detail="文件不存在或已过期")
+    
+    digest = await asyncio.get_running_loop().run_in_executor(None, file_digest, file_path)
+    
+    # 生成预览要运行三个 ffmpeg 进程，占用一个全局并发名额；已缓存或正在生成时不占用。
+    # 名额在生成任务结束时释放，客户端中途断开时 ffmpeg 仍在运行，名额也一直占用到那时
+    async def admit():
+        slot_id = f"preview-{uuid.uuid4()}"
+        if not await coordinated(job_coordinator, "try_acquire", slot_id, "preview", MAX_CONCURRENT_TASKS):
+            raise HTTPException(status_code=429, detail="服务器繁忙，请稍后重试")
+        return lambda _: asyncio.ensure_future(coordinated(job_coordinator, "release", slot_id))
+    
+    try:
+        key, manifest = await get_preview("ffmpeg", file_path, digest, format, admit=admit)
+    except (RuntimeError, asyncio.TimeoutError) as e:
+        logger.error(f"Preview generation failed for {filename}: {e}")
+        raise HTTPException(status_code=500, detail="生成预览失败")
+    return preview_response(key, manifest)
+
+@app.get("/preview/assets/{key}/{name}")
+async def preview_asset(key: str, name: str):
+    """预览文件按内容寻址，可长期缓存"""
+    if not re.fullmatch(r"[0-9a-f]{64}-(webp|jpg)", key) or not re.fullmatch(r"[a-z]+\.(webp|jpg|mp4)", name):
+        raise HTTPException(status_code=400, detail="无效的文件名")
+    path = preview_cache.asset_path(key, name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="预览不存在或已过期")
+    return FileResponse(
+        path,
+        media_type=asset_media_type(name),
+        headers={"Cache-Control": "public, max-age=86400, immutable"}
+    )
+
 @app.get("/status")
 async def get_status():
     """获取服务状态"""
     return {
-        "current_tasks": current_tasks,
+        "current_tasks": await coordinated(job_coordinator, "active_count"),
         "max_concurrent_tasks": MAX_CONCURRENT_TASKS,
+        "shared_state": job_coordinator.shared,
         "max_file_size_mb": MAX_FILE_SIZE // 1024 // 1024,
         "supported_video_formats": list(SUPPORTED_VIDEO_FORMATS),
         "supported_audio_formats": list(SUPPORTED_AUDIO_FORMATS),
         "ffmpeg_available": check_ffmpeg_available()
     }
 
+@app.get("/startup-report")
+async def startup_report():
+    """冷启动各阶段耗时"""
+    return startup_profile.report()
+
 # 错误处理
 @app.exception_handler(413)
 async def request_entity_too_large_handler(request, exc):
@@ -378,4 +613,6 @@ async def internal_server_error_handler(request, exc):
     return JSONResponse(
         status_code=500,
         content={"detail": "服务器内部错误，请稍后重试"}
-    )
\ No newline at end of file
+    )
+
+startup_profile.record("module_init", _import_started)
@@ -1,29 +1,96 @@
+import time
+_import_started = time.perf_counter()  # 冷启动计时起点
+
 import os
+import re
+import json
 import shutil
+import hashlib
+import functools
+import ipaddress
+import signal
 import logging
 import asyncio
-from typing import Optional
+from typing import Dict, Optional, Set
 from datetime import datetime, timedelta
-from fastapi import FastAPI, File, UploadFile, HTTPException, Query, Request
+from fastapi import FastAPI, File, UploadFile, HTTPException, Query, Request, Depends
 from fastapi.responses import FileResponse, JSONResponse, RedirectResponse
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
 import uuid
 import subprocess
-from fastapi.staticfiles import StaticFiles
 from contextlib import asynccontextmanager
 import tempfile
 from pathlib import Path
 
+try:
+    from . import _startup as startup_profile
+    from ._coordination import coordinated, create_coordinator, wait_for_slot
+    from ._output import (audio_output_args, commit_output, is_partial, partial_path,
+                          video_output_args, verify_faststart)
+    from ._audio import (AUDIO_CONTENT_TYPES, AUDIO_FORMATS, audio_encode_args,
+                         ffprobe_for, plan_audio)
+    from ._history import DuplicateTask, JobHistory
+    from ._journal import JobJournal
+    from ._preview import (PREVIEW_TIMEOUT, SPRITE_FORMATS, asset_media_type, file_digest,
+                           get_preview, preview_cache, preview_response)
+except ImportError:
+    import _startup as startup_profile
+    from _coordination import coordinated, create_coordinator, wait_for_slot
+    from _output import (audio_output_args, commit_output, is_partial, partial_path,
+                         video_output_args, verify_faststart)
+    from _audio import (AUDIO_CONTENT_TYPES, AUDIO_FORMATS, audio_encode_args,
+                        ffprobe_for, plan_audio)
+    from _history import DuplicateTask, JobHistory
+    from _journal import JobJournal
+    from _preview import (PREVIEW_TIMEOUT, SPRITE_FORMATS, asset_media_type, file_digest,
+                          get_preview, preview_cache, preview_response)
+
 # 配置日志
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
+startup_profile.set_process_started(_import_started)
+startup_profile.record("imports", _import_started)
 
 # 全局变量
-processing_tasks = set()  # 跟踪正在处理的任务
+job_coordinator = create_coordinator()  # 跟踪正在处理的任务（多 worker 时跨进程共享）
+running_processes: Dict[str, Set[asyncio.subprocess.Process]] = {}  # 任务 ID -> 正在运行的 ffmpeg 进程
+cancelled_tasks = set()  # 本 worker 内已被取消（客户端断开或 DELETE /jobs）的任务
+DISCONNECT_POLL_INTERVAL = 1.0  # 检测客户端断开的轮询间隔（秒）
+inflight: Dict[str, "Flight"] = {}  # 合并键（内容哈希 + 参数）-> 正在进行的编码
+waiter_flights: Dict[str, "Flight"] = {}  # 请求的任务 ID -> 它所等待的编码
+detached_waiters = set()  # 被 DELETE /jobs 取消、应停止等待的请求
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 保存上传文件时每次读取的字节数
+FFMPEG_TIMEOUT = 280  # 单个 ffmpeg 进程的超时时间（秒）
+job_history = JobHistory()  # 持久化的任务历史，用于统计和按客户端配额
+job_journal = JobJournal()  # 未完成任务的日志，重启后重新排队被中断的任务
+shutting_down = False  # 关闭期间被中断的任务保留输入文件和日志，留待重启后继续
+JOBS_ADMIN_TOKEN = os.environ.get("JOBS_ADMIN_TOKEN")  # /jobs 列表、统计与正在处理的任务需要的 Bearer token，未设置时只允许本机访问
+TRUST_PROXY = int(os.environ.get("TRUST_PROXY", "0"))  # 服务前面的可信代理层数，0 表示不信任 X-Forwarded-For
+FFMPEG_PATHS = [
+    "ffmpeg",
+    "/usr/bin/ffmpeg", 
+    "/opt/ffmpeg/bin/ffmpeg",
+    "/usr/local/bin/ffmpeg"
+]
+
+# 质量目标模式：对若干采样片段按不同 CRF 试编码并打分，选出满足目标质量的最大 CRF
+DEFAULT_CRF = 32
+QUALITY_CRF_CANDIDATES = [23, 26, 29, 32, 35]
+QUALITY_SAMPLE_WINDOWS = 3  # 采样片段数量
+QUALITY_SAMPLE_SECONDS = 4.0  # 每个采样片段的时长（秒）
+QUALITY_PARALLELISM = max(1, min(os.cpu_count() or 1, 4))  # 本 worker 内所有任务合计并行试编码的进程数
+_quality_slots: Optional[asyncio.Semaphore] = None  # 所有质量目标任务共享，避免多个任务同时采样时超额占用 CPU
+QUALITY_METRICS = {
+    # 指标名 -> (默认目标值, 需要的 ffmpeg 滤镜)
+    "ssim": (0.95, "ssim"),
+    "psnr": (36.0, "psnr"),
+    "vmaf": (85.0, "libvmaf"),
+}
 MAX_CONCURRENT_TASKS = 3  # 最大并发任务数
 FILE_SIZE_LIMIT = 50 * 1024 * 1024  # 50MB
 ALLOWED_ORIGINS = [
@@ -38,8 +105,14 @@ ALLOWED_ORIGINS = [
 # Vercel 上的临时目录
 UPLOAD_DIR = "/tmp/uploads"
 OUTPUT_DIR = "/tmp/outputs"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+_dirs_ready = False  # 目录在第一次上传时才创建
+
+# 临时文件清理不在启动路径上执行，而是在后台按间隔运行
+MAINTENANCE_INTERVAL = 600  # 秒
+_last_maintenance = 0.0
+
+# 前端页面（仓库根目录的 index.html）
+INDEX_HTML = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "index.html")
 
 # 支持的文件类型和 MIME 类型
 SUPPORTED_VIDEO_TYPES = {
@@ -61,11 +134,17 @@ SUPPORTED_AUDIO_TYPES = {
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # 启动时清理临时文件
-    cleanup_temp_files()
+    global shutting_down
+    # 启动时不做阻塞工作，临时文件和过期任务历史在后台清理，被中断的任务在后台重新排队
+    asyncio.get_running_loop().run_in_executor(None, run_maintenance)
+    asyncio.ensure_future(resume_interrupted_jobs())
     yield
-    # 关闭时清理
-    cleanup_temp_files()
+    # 关闭时终止正在运行的 ffmpeg（进程以独立会话启动，不会随 worker 退出），
+    # 未完成的任务保留在日志中，不再删除临时文件
+    shutting_down = True
+    for processes in list(running_processes.values()):
+        for process in list(processes):
+            kill_process_tree(process)
 
 app = FastAPI(
     title="视频音频压缩工具",
@@ -85,32 +164,144 @@ app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # 部署成功后可以限制为特定域名
     allow_credentials=False,  # 允许所有来源时必须设为 False
-    allow_methods=["GET", "POST"],
+    allow_methods=["GET", "POST", "DELETE"],
     allow_headers=["*"],
 )
 
-# 静态文件服务 - 指向根目录
-app.mount("/static", StaticFiles(directory=".", html=True), name="static")
+app.add_middleware(startup_profile.FirstRequestMiddleware)
 
 @app.get("/")
 def root():
     return RedirectResponse(url="/static/index.html")
 
+# 只提供前端页面，不再把整个仓库目录挂载为静态文件
+@app.get("/static/index.html")
+def index_page():
+    return FileResponse(INDEX_HTML, media_type="text/html")
+
+def ensure_dirs():
+    """惰性创建上传与输出目录"""
+    global _dirs_ready
+    if not _dirs_ready:
+        with startup_profile.timed("ensure_dirs"):
+            os.makedirs(UPLOAD_DIR, exist_ok=True)
+            os.makedirs(OUTPUT_DIR, exist_ok=True)
+        _dirs_ready = True
+
+def run_maintenance(force: bool = False):
+    """清理过期临时文件和任务历史，距上次运行不足 MAINTENANCE_INTERVAL 时跳过"""
+    global _last_maintenance
+    now = time.monotonic()
+    if not force and _last_maintenance and now - _last_maintenance < MAINTENANCE_INTERVAL:
+        return
+    _last_maintenance = now
+    with startup_profile.timed("maintenance"):
+        cleanup_temp_files()
+        record_history(job_history.prune)
+        record_history(job_journal.prune)
+        record_history(preview_cache.evict)
+
 def cleanup_temp_files():
-    """清理超过1小时的临时文件"""
+    """清理超过1小时的临时文件（日志中未完成任务的输入文件除外）"""
     try:
         temp_dirs = [UPLOAD_DIR, OUTPUT_DIR]
         cutoff_time = datetime.now() - timedelta(hours=1)
+        pending = job_journal.pending_inputs()
         
         for temp_dir in temp_dirs:
             if os.path.exists(temp_dir):
                 for file_path in Path(temp_dir).glob('*'):
+                    if str(file_path) in pending:
+                        continue
                     if file_path.stat().st_mtime < cutoff_time.timestamp():
-                        file_path.unlink(missing_ok=True)
+                        if file_path.is_dir():
+                            shutil.rmtree(file_path, ignore_errors=True)
+                        else:
+                            file_path.unlink(missing_ok=True)
                         logger.info(f"清理临时文件: {file_path}")
     except Exception as e:
         logger.error(f"清理临时文件失败: {e}")
 
+def record_history(method, *args, **kwargs):
+    """写入任务历史；历史库异常不应影响文件处理"""
+    try:
+        return method(*args, **kwargs)
+    except Exception as e:
+        logger.error(f"写入任务历史失败: {e}")
+
+async def record_history_async(method, *args, **kwargs):
+    """在异步代码中写入任务历史或任务日志
+
+    SQLite 文件由多个 worker 共享，写入可能等待写锁（最长 10 秒），放到线程池中执行，避免阻塞事件循环。
+    """
+    return await asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(record_history, method, *args, **kwargs)
+    )
+
+def get_client_id(request: Request) -> str:
+    """客户端标识，用于配额
+
+    只有配置了 TRUST_PROXY 时才读取 X-Forwarded-For：客户端可以自行伪造该请求头，
+    每层代理会在末尾追加它看到的地址，因此取倒数第 TRUST_PROXY 个地址。
+    """
+    forwarded = request.headers.get("x-forwarded-for")
+    if TRUST_PROXY and forwarded:
+        hops = [hop.strip() for hop in forwarded.split(",") if hop.strip()]
+        if hops:
+            return hops[-min(TRUST_PROXY, len(hops))]
+    return request.client.host if request.client else "unknown"
+
+def has_admin_token(request: Request) -> bool:
+    return bool(JOBS_ADMIN_TOKEN) and request.headers.get("authorization") == f"Bearer {JOBS_ADMIN_TOKEN}"
+
+def is_loopback(request: Request) -> bool:
+    try:
+        return ipaddress.ip_address(get_client_id(request)).is_loopback
+    except ValueError:
+        return False
+
+def require_admin(request: Request):
+    """管理接口会暴露客户端地址、文件名和任务 ID：配置了 JOBS_ADMIN_TOKEN 时要求 Bearer token，
+    未配置时只允许本机访问"""
+    if JOBS_ADMIN_TOKEN:
+        if not has_admin_token(request):
+            raise HTTPException(status_code=401, detail="未授权")
+    elif not is_loopback(request):
+        raise HTTPException(status_code=403, detail="未配置 JOBS_ADMIN_TOKEN，管理接口只允许本机访问")
+
+def may_cancel(request: Request, task_id: str) -> bool:
+    """只有提交任务的客户端（或持有管理 token 的调用方）可以取消任务"""
+    if has_admin_token(request):
+        return True
+    job = job_history.get(task_id)
+    return job is not None and job["client"] == get_client_id(request)
+
+def read_progress_stats(progress_path: str) -> dict:
+    """从 ffmpeg -progress 输出中读取最终的编码速度和输出时长"""
+    stats = {}
+    try:
+        with open(progress_path, "r") as f:
+            for line in f:
+                key, _, value = line.strip().partition("=")
+                if key in ("fps", "out_time_us", "out_time_ms", "frame"):
+                    stats[key] = value
+    except OSError:
+        return {}
+    
+    result = {}
+    try:
+        fps = float(stats.get("fps", 0))
+        result["encoder_fps"] = fps or None
+    except ValueError:
+        pass
+    # out_time_ms 实际上也是微秒
+    out_time = stats.get("out_time_us") or stats.get("out_time_ms")
+    try:
+        result["media_seconds"] = int(out_time) / 1_000_000 if out_time else None
+    except ValueError:
+        pass
+    return result
+
 def validate_file_type(file: UploadFile) -> tuple[bool, str]:
     """严格验证文件类型"""
     if not file.filename:
@@ -131,31 +322,305 @@ def is_audio(filename: str) -> bool:
     ext = os.path.splitext(filename.lower())[1]
     return ext in SUPPORTED_AUDIO_TYPES
 
-async def compress_video_async(input_path: str, output_path: str, progress_path: Optional[str] = None):
-    # 检查 FFmpeg 是否可用
-    ffmpeg_paths = [
-        "ffmpeg",
-        "/usr/bin/ffmpeg", 
-        "/opt/ffmpeg/bin/ffmpeg",
-        "/usr/local/bin/ffmpeg"
-    ]
+TASK_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")  # 客户端指定的任务 ID 会用于文件名
+
+class JobCancelled(Exception):
+    """任务因客户端断开或显式取消而终止"""
+
+class Flight:
+    """一次正在进行的编码；本 worker 内内容与参数都相同的并发上传共享同一个 Flight"""
+
+    def __init__(self, key: str, job_id: str, persistent: bool = False):
+        self.key = key
+        self.job_id = job_id  # 实际执行编码的任务 ID（第一个上传者），名额、进度和输出文件都以它为准
+        self.waiters: Dict[str, Request] = {}  # 等待结果的请求：任务 ID -> 请求
+        self.task: Optional[asyncio.Future] = None
+        # 重启后恢复的任务没有请求在等待，结果通过 GET /jobs/{task_id} 查询，
+        # 不能因为合并进来的请求离开而被终止
+        self.persistent = persistent
+
+def save_upload(file: UploadFile, input_path: str) -> str:
+    """分块保存上传文件，同时计算 SHA-256 用于识别重复上传"""
+    digest = hashlib.sha256()
+    with open(input_path, "wb") as f:
+        while True:
+            chunk = file.file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            f.write(chunk)
+    return digest.hexdigest()
+
+def coalesce_key(digest: str, kind: str, options: dict) -> str:
+    """相同内容、相同类型和相同压缩参数的任务会得到相同的合并键"""
+    return f"{kind}:{digest}:{json.dumps(options, sort_keys=True)}"
+
+def abandon_flight_if_unwatched(flight: Flight):
+    """没有任何请求再等待该编码时终止 ffmpeg，名额在编码任务退出时释放"""
+    if flight.persistent or flight.waiters or flight.task is None or flight.task.done():
+        return
+    logger.info(f"无请求等待，终止任务: {flight.job_id}")
+    # 立即移出合并表：之后到达的相同上传应重新编码，而不是加入一个正在终止的编码
+    if inflight.get(flight.key) is flight:
+        inflight.pop(flight.key)
+    cancelled_tasks.add(flight.job_id)
+    for process in list(running_processes.get(flight.job_id, ())):
+        kill_process_tree(process)
+
+async def wait_for_flight(flight: Flight, waiter_id: str, request: Request) -> dict:
+    """等待共享编码完成；客户端断开或被取消时只让当前请求退出"""
+    while True:
+        done, _ = await asyncio.wait({flight.task}, timeout=DISCONNECT_POLL_INTERVAL)
+        if done:
+            return flight.task.result()
+        if waiter_id in detached_waiters:
+            raise JobCancelled(waiter_id)
+        if await request.is_disconnected():
+            logger.info(f"客户端已断开，停止等待任务: {waiter_id}")
+            raise JobCancelled(waiter_id)
+
+def kill_process_tree(process: asyncio.subprocess.Process):
+    """终止 ffmpeg 及其子进程（进程以独立会话启动，整组发送 SIGKILL）"""
+    if process.returncode is not None:
+        return
+    try:
+        if hasattr(os, "killpg"):
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except ProcessLookupError:
+        pass
+    except Exception as e:
+        logger.error(f"终止进程失败: {e}")
+        process.kill()
+
+_ffmpeg_cmd_cache: Optional[str] = None  # 已确认可用的 ffmpeg 路径，避免每个任务重复探测
+
+async def find_ffmpeg() -> Optional[str]:
+    """依次尝试候选路径，返回第一个可用的 ffmpeg（找到后缓存）"""
+    global _ffmpeg_cmd_cache
+    if _ffmpeg_cmd_cache and (not os.path.isabs(_ffmpeg_cmd_cache) or os.path.exists(_ffmpeg_cmd_cache)):
+        return _ffmpeg_cmd_cache
+    with startup_profile.timed("ffmpeg_probe"):
+        for path in FFMPEG_PATHS:
+            try:
+                # 测试 FFmpeg 是否可用
+                process = await asyncio.create_subprocess_exec(
+                    path, "-version",
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE
+                )
+                await process.communicate()
+                if process.returncode == 0:
+                    _ffmpeg_cmd_cache = path
+                    return path
+            except FileNotFoundError:
+                continue
+    return None
+
+async def is_task_cancelled(task_id: str) -> bool:
+    """取消请求可能由其他 worker 接收，因此同时检查共享任务表"""
+    if task_id in cancelled_tasks:
+        return True
+    if not await coordinated(job_coordinator, "is_cancelled", task_id):
+        return False
     
-    ffmpeg_cmd = None
-    for path in ffmpeg_paths:
-        try:
-            # 测试 FFmpeg 是否可用
-            process = await asyncio.create_subprocess_exec(
-                path, "-version",
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            await process.communicate()
-            if process.returncode == 0:
-                ffmpeg_cmd = path
+    # 其他 worker 收到的取消请求只针对发起编码的那个请求：与本 worker 上 DELETE 的处理一致，
+    # 让该请求退出等待，仍有合并进来的请求在等待时继续编码
+    flight = next((f for f in inflight.values() if f.job_id == task_id), None)
+    if flight is not None:
+        if flight.waiters.pop(task_id, None) is not None:
+            detached_waiters.add(task_id)
+        flight.persistent = False
+        if flight.waiters:
+            logger.info(f"取消任务 - 任务ID: {task_id}，仍有合并的请求在等待，继续编码")
+            await coordinated(job_coordinator, "clear_cancel", task_id)
+            return False
+    cancelled_tasks.add(task_id)
+    return True
+
+async def run_ffmpeg(cmd: list, task_id: Optional[str] = None, request: Optional[Request] = None,
+                     timeout: float = FFMPEG_TIMEOUT) -> tuple[int, bytes]:
+    """运行 ffmpeg，期间监测客户端断开与取消请求，返回 (returncode, stderr)"""
+    if task_id and await is_task_cancelled(task_id):
+        raise JobCancelled(task_id)
+
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=hasattr(os, "killpg")
+    )
+    if task_id:
+        running_processes.setdefault(task_id, set()).add(process)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    communicate = asyncio.ensure_future(process.communicate())
+    try:
+        while True:
+            done, _ = await asyncio.wait({communicate}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                # 进程可能是被取消操作直接终止的
+                if process.returncode != 0 and task_id and await is_task_cancelled(task_id):
+                    raise JobCancelled(task_id)
                 break
-        except FileNotFoundError:
-            continue
+            if task_id and await is_task_cancelled(task_id):
+                kill_process_tree(process)
+                await communicate
+                raise JobCancelled(task_id)
+            if request is not None and await request.is_disconnected():
+                logger.info(f"客户端已断开，终止任务: {task_id}")
+                kill_process_tree(process)
+                await communicate
+                raise JobCancelled(task_id)
+            if loop.time() > deadline:
+                kill_process_tree(process)
+                await communicate
+                raise asyncio.TimeoutError()
+        _, stderr = communicate.result()
+        return process.returncode, stderr or b""
+    finally:
+        if not communicate.done():
+            kill_process_tree(process)
+            communicate.cancel()
+        if task_id:
+            procs = running_processes.get(task_id)
+            if procs is not None:
+                procs.discard(process)
+                if not procs:
+                    running_processes.pop(task_id, None)
+
+async def probe_duration(ffmpeg_cmd: str, input_path: str) -> Optional[float]:
+    """使用 ffprobe 获取媒体时长（秒），失败时返回 None"""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            ffprobe_for(ffmpeg_cmd), "-v", "error",
+            "-show_entries", "format=duration",
+            "-of", "default=noprint_wrappers=1:nokey=1",
+            input_path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, _ = await asyncio.wait_for(process.communicate(), timeout=30)
+        return float(stdout.decode().strip())
+    except (FileNotFoundError, ValueError, asyncio.TimeoutError):
+        return None
+
+async def has_ffmpeg_filter(ffmpeg_cmd: str, name: str) -> bool:
+    """检查本地 ffmpeg 是否编译了指定滤镜（如 libvmaf）"""
+    process = await asyncio.create_subprocess_exec(
+        ffmpeg_cmd, "-hide_banner", "-filters",
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, _ = await process.communicate()
+    return re.search(rf"^\s*\S+\s+{re.escape(name)}\s", stdout.decode(errors="replace"), re.M) is not None
+
+def sample_windows(duration: Optional[float]) -> list[tuple[float, float]]:
+    """在视频的 20%~80% 区间内均匀选取采样片段，返回 [(起点, 时长)]"""
+    if not duration or duration <= QUALITY_SAMPLE_SECONDS * QUALITY_SAMPLE_WINDOWS:
+        return [(0.0, duration or QUALITY_SAMPLE_SECONDS)]
+    windows = []
+    for i in range(QUALITY_SAMPLE_WINDOWS):
+        position = 0.2 + 0.6 * i / max(QUALITY_SAMPLE_WINDOWS - 1, 1)
+        start = min(duration * position, duration - QUALITY_SAMPLE_SECONDS)
+        windows.append((round(start, 3), QUALITY_SAMPLE_SECONDS))
+    return windows
+
+def parse_quality_score(metric: str, stderr: str) -> Optional[float]:
+    """从 ffmpeg 滤镜输出中解析质量分数"""
+    patterns = {
+        "ssim": r"SSIM .*All:([\d.]+)",
+        "psnr": r"PSNR .*average:([\d.]+|inf)",
+        "vmaf": r"VMAF score[:=]\s*([\d.]+)",
+    }
+    matches = re.findall(patterns[metric], stderr)
+    if not matches:
+        return None
+    value = matches[-1]
+    return 100.0 if value == "inf" else float(value)
+
+async def score_sample(ffmpeg_cmd: str, input_path: str, window: tuple[float, float], crf: int,
+                       metric: str, work_dir: str, limiter: asyncio.Semaphore,
+                       task_id: Optional[str] = None, request: Optional[Request] = None) -> Optional[float]:
+    """以指定 CRF 编码一个采样片段，并与同分辨率的原始片段比较打分"""
+    start, length = window
+    sample_path = os.path.join(work_dir, f"crf{crf}_{start}.mp4")
+    seek = ["-ss", str(start), "-t", str(length)]
+    encode_cmd = [
+        ffmpeg_cmd, "-y", *seek, "-i", input_path,
+        "-vf", "scale=-2:480",
+        "-c:v", "libx264", "-preset", "veryfast", "-crf", str(crf),
+        "-an", sample_path
+    ]
+    metric_filter = QUALITY_METRICS[metric][1]
+    score_cmd = [
+        ffmpeg_cmd, "-hide_banner", *seek, "-i", input_path, "-i", sample_path,
+        "-lavfi", f"[0:v]scale=-2:480,setpts=PTS-STARTPTS[ref];[1:v]setpts=PTS-STARTPTS[dist];[dist][ref]{metric_filter}",
+        "-f", "null", "-"
+    ]
+    async with limiter:
+        returncode, _ = await run_ffmpeg(encode_cmd, task_id, request)
+        if returncode != 0:
+            return None
+        returncode, stderr = await run_ffmpeg(score_cmd, task_id, request)
+    if returncode != 0:
+        return None
+    return parse_quality_score(metric, stderr.decode(errors="replace"))
+
+async def choose_crf(ffmpeg_cmd: str, input_path: str, target: Optional[float], metric: str = "ssim",
+                     task_id: Optional[str] = None, request: Optional[Request] = None) -> tuple[int, Optional[float]]:
+    """并行试编码所有 (CRF, 采样片段) 组合，返回满足目标质量的最大 CRF 及其平均分数"""
+    if metric == "vmaf" and not await has_ffmpeg_filter(ffmpeg_cmd, "libvmaf"):
+        logger.info("本地 ffmpeg 不支持 libvmaf，改用 SSIM")
+        metric, target = "ssim", None
+    if target is None:
+        target = QUALITY_METRICS[metric][0]
+    
+    global _quality_slots
+    if _quality_slots is None:
+        # 在事件循环内创建，避免绑定到导入时的循环
+        _quality_slots = asyncio.Semaphore(QUALITY_PARALLELISM)
+    
+    windows = sample_windows(await probe_duration(ffmpeg_cmd, input_path))
+    work_dir = tempfile.mkdtemp(prefix=f"{task_id or 'quality'}_", dir=UPLOAD_DIR)
+    jobs = [
+        asyncio.ensure_future(
+            score_sample(ffmpeg_cmd, input_path, window, crf, metric, work_dir, _quality_slots, task_id, request)
+        )
+        for crf in QUALITY_CRF_CANDIDATES for window in windows
+    ]
+    try:
+        scores = await asyncio.gather(*jobs)
+    except BaseException:
+        # 任一试编码被取消或超时时，终止其余仍在运行的试编码
+        for job in jobs:
+            job.cancel()
+        await asyncio.gather(*jobs, return_exceptions=True)
+        raise
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    
+    averages = {}
+    for index, crf in enumerate(QUALITY_CRF_CANDIDATES):
+        crf_scores = scores[index * len(windows):(index + 1) * len(windows)]
+        if all(score is not None for score in crf_scores):
+            averages[crf] = sum(crf_scores) / len(crf_scores)
+    if not averages:
+        logger.warning(f"质量评估失败，使用默认 CRF {DEFAULT_CRF}")
+        return DEFAULT_CRF, None
     
+    passing = [crf for crf, score in averages.items() if score >= target]
+    crf = max(passing) if passing else min(averages)
+    logger.info(f"质量目标 {metric}>={target} - 任务ID: {task_id}, 各 CRF 分数: {averages}, 选择 CRF {crf}")
+    return crf, averages[crf]
+
+async def compress_video_async(input_path: str, output_path: str, progress_path: Optional[str] = None,
+                               task_id: Optional[str] = None, request: Optional[Request] = None,
+                               crf: int = DEFAULT_CRF):
+    # 检查 FFmpeg 是否可用
+    ffmpeg_cmd = await find_ffmpeg()
     if not ffmpeg_cmd:
         logger.error("FFmpeg 不可用")
         raise HTTPException(
@@ -166,59 +631,35 @@ async def compress_video_async(input_path: str, output_path: str, progress_path:
     cmd = [
         ffmpeg_cmd, "-y", "-i", input_path,
         "-vf", "scale=-2:480",
-        "-c:v", "libx264", "-preset", "veryfast", "-crf", "32",
+        "-c:v", "libx264", "-preset", "veryfast", "-crf", str(crf),
         "-c:a", "aac", "-b:a", "64k",
+        *video_output_args(),
     ]
     if progress_path:
         cmd += ["-progress", progress_path, "-nostats"]
     cmd.append(output_path)
     
     try:
-        # 使用 asyncio 运行 subprocess
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=280)
+        # 运行 ffmpeg，客户端断开或任务取消时终止进程
+        returncode, stderr = await run_ffmpeg(cmd, task_id, request)
         
-        if process.returncode != 0:
-            logger.error(f"FFmpeg 错误: {stderr.decode()}")
-            raise subprocess.CalledProcessError(process.returncode, cmd)
+        if returncode != 0:
+            logger.error(f"FFmpeg 错误: {stderr.decode(errors='replace')}")
+            raise subprocess.CalledProcessError(returncode, cmd)
             
     except asyncio.TimeoutError:
-        if process:
-            process.terminate()
-            await process.wait()
-        raise subprocess.TimeoutExpired(cmd, 280)
+        raise subprocess.TimeoutExpired(cmd, FFMPEG_TIMEOUT)
+    except (JobCancelled, subprocess.CalledProcessError):
+        raise
     except Exception as e:
         logger.error(f"视频处理异常: {e}")
         raise HTTPException(status_code=500, detail="视频处理失败")
 
-async def compress_audio_async(input_path: str, output_path: str, progress_path: Optional[str] = None):
-    # 检查 FFmpeg 是否可用（与视频处理相同的逻辑）
-    ffmpeg_paths = [
-        "ffmpeg",
-        "/usr/bin/ffmpeg", 
-        "/opt/ffmpeg/bin/ffmpeg",
-        "/usr/local/bin/ffmpeg"
-    ]
-    
-    ffmpeg_cmd = None
-    for path in ffmpeg_paths:
-        try:
-            process = await asyncio.create_subprocess_exec(
-                path, "-version",
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            await process.communicate()
-            if process.returncode == 0:
-                ffmpeg_cmd = path
-                break
-        except FileNotFoundError:
-            continue
-    
+async def compress_audio_async(input_path: str, output_path: str, progress_path: Optional[str] = None,
+                               task_id: Optional[str] = None, request: Optional[Request] = None,
+                               profile: Optional[dict] = None, loudnorm: bool = False):
+    # 检查 FFmpeg 是否可用
+    ffmpeg_cmd = await find_ffmpeg()
     if not ffmpeg_cmd:
         logger.error("FFmpeg 不可用")
         raise HTTPException(
@@ -226,42 +667,41 @@ async def compress_audio_async(input_path: str, output_path: str, progress_path:
             detail="音频处理服务暂时不可用，正在维护中"
         )
         
+    # 按声道数和内容类型选择编码器与码率，输出扩展名需与 profile["ext"] 一致
+    if profile is None:
+        profile = await plan_audio(ffmpeg_cmd, input_path)
+    
     cmd = [
         ffmpeg_cmd, "-y", "-i", input_path,
-        "-vn", "-ar", "44100", "-ac", "2", "-b:a", "64k",
+        *audio_encode_args(profile, loudnorm),
+        *audio_output_args(),
     ]
     if progress_path:
         cmd += ["-progress", progress_path, "-nostats"]
     cmd.append(output_path)
     
     try:
-        # 使用 asyncio 运行 subprocess
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=280)
+        # 运行 ffmpeg，客户端断开或任务取消时终止进程
+        returncode, stderr = await run_ffmpeg(cmd, task_id, request)
         
-        if process.returncode != 0:
-            logger.error(f"FFmpeg 错误: {stderr.decode()}")
-            raise subprocess.CalledProcessError(process.returncode, cmd)
+        if returncode != 0:
+            logger.error(f"FFmpeg 错误: {stderr.decode(errors='replace')}")
+            raise subprocess.CalledProcessError(returncode, cmd)
             
     except asyncio.TimeoutError:
-        if process:
-            process.terminate()
-            await process.wait()
-        raise subprocess.TimeoutExpired(cmd, 280)
+        raise subprocess.TimeoutExpired(cmd, FFMPEG_TIMEOUT)
+    except (JobCancelled, subprocess.CalledProcessError):
+        raise
     except Exception as e:
         logger.error(f"音频处理异常: {e}")
         raise HTTPException(status_code=500, detail="音频处理失败")
 
 @app.post("/upload")
-async def upload_file(request: Request, file: UploadFile = File(...), task_id: str = Query(None)):
-    # 检查并发任务数
-    if len(processing_tasks) >= MAX_CONCURRENT_TASKS:
-        raise HTTPException(status_code=429, detail="服务器繁忙，请稍后重试")
-    
+async def upload_file(request: Request, file: UploadFile = File(...), task_id: str = Query(None),
+                      quality_mode: bool = Query(False), quality_metric: str = Query("ssim"),
+                      quality_target: Optional[float] = Query(None),
+                      audio_format: str = Query("auto"), audio_content: Optional[str] = Query(None),
+                      loudnorm: bool = Query(False)):
     # 验证文件
     if not file.filename:
         raise HTTPException(status_code=400, detail="请选择文件")
@@ -275,55 +715,248 @@ async def upload_file(request: Request, file: UploadFile = File(...), task_id: s
     if not is_valid:
         raise HTTPException(status_code=400, detail=error_msg)
     
+    if quality_mode and quality_metric not in QUALITY_METRICS:
+        raise HTTPException(status_code=400, detail=f"不支持的质量指标: {quality_metric}")
+    if audio_format not in AUDIO_FORMATS:
+        raise HTTPException(status_code=400, detail=f"不支持的音频格式: {audio_format}")
+    if audio_content is not None and audio_content not in AUDIO_CONTENT_TYPES:
+        raise HTTPException(status_code=400, detail=f"不支持的音频内容类型: {audio_content}")
+    
     # 记录客户端信息（用于监控）
-    client_ip = request.client.host if request.client else "unknown"
+    client_ip = get_client_id(request)
     logger.info(f"文件上传请求 - IP: {client_ip}, 文件: {file.filename}, 大小: {getattr(file, 'size', 'unknown')}")
     
+    if task_id is not None and not TASK_ID_PATTERN.fullmatch(task_id):
+        raise HTTPException(status_code=400, detail="任务ID只能包含字母、数字、下划线和连字符，最长 64 个字符")
     file_id = task_id or str(uuid.uuid4())
+    kind = "video" if is_video(file.filename) else "audio"
+    
+    # 按客户端配额，防止单个客户端占满并发名额；检查与写入 running 记录原子完成，
+    # 并发上传无法同时通过检查。已被使用的任务 ID 直接拒绝，不能接管其他任务
+    try:
+        within_quota, quota_msg = await asyncio.get_running_loop().run_in_executor(
+            None, job_history.reserve, file_id, client_ip, kind, file.filename, getattr(file, "size", None) or 0
+        )
+    except DuplicateTask:
+        raise HTTPException(status_code=409, detail="任务ID已存在")
+    if not within_quota:
+        logger.info(f"超出配额 - IP: {client_ip}, 原因: {quota_msg}")
+        raise HTTPException(status_code=429, detail=quota_msg)
+    
     ext = os.path.splitext(file.filename)[-1]
     input_path = os.path.join(UPLOAD_DIR, file_id + ext)
+    # 先保存到服务端生成的临时文件名，占到名额后才改名为任务的输入文件，
+    # 失败时只删除本请求写入的文件
+    upload_path = os.path.join(UPLOAD_DIR, f".upload-{uuid.uuid4().hex}{ext}")
+    try:
+        ensure_dirs()
+        digest = await asyncio.get_running_loop().run_in_executor(None, save_upload, file, upload_path)
+        input_size = os.path.getsize(upload_path)
+        options = {
+            "quality_mode": quality_mode, "quality_metric": quality_metric, "quality_target": quality_target,
+            "audio_format": audio_format, "audio_content": audio_content, "loudnorm": loudnorm,
+        }
+        key = coalesce_key(digest, kind, options)
+        
+        flight = inflight.get(key)
+        if flight is not None:
+            # 相同内容、相同参数的任务正在处理：不再占用名额，直接共享其结果与进度
+            os.remove(upload_path)
+            logger.info(f"合并重复上传 - 任务ID: {file_id} -> {flight.job_id}")
+            await record_history_async(job_history.start, file_id, client_ip, kind, file.filename, input_size,
+                                       {"coalesced_with": flight.job_id})
+        else:
+            # 原子地占用全局并发名额（多 worker 时与其他进程竞争同一上限）
+            if not await coordinated(job_coordinator, "try_acquire", file_id, kind, MAX_CONCURRENT_TASKS):
+                raise HTTPException(status_code=429, detail="服务器繁忙，请稍后重试")
+            os.replace(upload_path, input_path)
+            await record_history_async(job_history.start, file_id, client_ip, kind, file.filename, input_size)
+            await record_history_async(job_journal.add, file_id, key, kind, file.filename, client_ip,
+                                       input_path, options)
+            flight = start_flight(key, file_id, input_path, file.filename, options)
+    except BaseException:
+        # 未开始处理的任务不计入配额
+        await record_history_async(job_history.release, file_id)
+        if os.path.exists(upload_path):
+            os.remove(upload_path)
+        raise
     
-    with open(input_path, "wb") as f:
-        shutil.copyfileobj(file.file, f)
+    flight.waiters[file_id] = request
+    waiter_flights[file_id] = flight
+    coalesced = file_id != flight.job_id
+    started = time.monotonic()
+    failure = None
+    try:
+        result = dict(await wait_for_flight(flight, file_id, request))
+    except JobCancelled:
+        failure = ("cancelled", "任务已取消")
+        logger.info(f"任务已取消 - 任务ID: {file_id}")
+        raise HTTPException(status_code=409, detail="任务已取消")
+    except HTTPException as e:
+        failure = ("failed", str(e.detail))
+        raise
+    finally:
+        flight.waiters.pop(file_id, None)
+        waiter_flights.pop(file_id, None)
+        detached_waiters.discard(file_id)
+        abandon_flight_if_unwatched(flight)
+        if coalesced:
+            status, error = failure or ("success", None)
+            await record_history_async(job_history.finish, file_id, status,
+                                       encode_seconds=round(time.monotonic() - started, 3), error=error)
+    
+    if coalesced:
+        result["coalesced"] = True
     
+    # 响应发送后顺带执行（按间隔节流的）临时文件清理
+    return JSONResponse(result, background=BackgroundTask(run_maintenance))
+
+def start_flight(key: str, job_id: str, input_path: str, filename: str, options: dict,
+                 persistent: bool = False) -> Flight:
+    """登记并在后台启动一次编码（调用方需已占用并发名额）"""
+    flight = Flight(key, job_id, persistent)
+    inflight[key] = flight
+    flight.task = asyncio.ensure_future(run_encode(flight, input_path, filename, options))
+    # 所有等待者都离开时，避免未读取的异常被记录为警告
+    flight.task.add_done_callback(lambda task: task.cancelled() or task.exception())
+    return flight
+
+async def resume_interrupted_jobs():
+    """重新排队上一次运行中被中断的任务，结果可通过 GET /jobs/{task_id} 查询"""
+    try:
+        jobs = await asyncio.get_running_loop().run_in_executor(None, job_journal.claim_interrupted)
+    except Exception as e:
+        logger.error(f"读取任务日志失败: {e}")
+        return
+    for job in jobs:
+        logger.info(f"恢复中断的任务 - 任务ID: {job['task_id']}, 文件: {job['filename']}")
+        ensure_dirs()
+        await record_history_async(job_history.start, job["task_id"], job["client"], job["kind"],
+                                   job["filename"], os.path.getsize(job["input_path"]))
+        await wait_for_slot(job_coordinator, job["task_id"], job["kind"], MAX_CONCURRENT_TASKS)
+        start_flight(job["coalesce_key"], job["task_id"], job["input_path"], job["filename"], job["options"],
+                     persistent=True)
+
+async def run_encode(flight: Flight, input_path: str, filename: str, options: dict) -> dict:
+    """执行一次编码；结果由所有等待该 Flight 的请求共享
+
+    编码不绑定任何单个请求：客户端断开只会使该请求退出等待，
+    所有等待者都离开后才由 abandon_flight_if_unwatched 终止 ffmpeg。
+    """
+    file_id = flight.job_id
+    kind = "video" if is_video(filename) else "audio"
     result = {}
     progress_path = os.path.join(OUTPUT_DIR, file_id + ".progress")
+    output_path = None
+    succeeded = False
+    failure = None
+    job_profile = {}
     
-    # 添加到处理任务集合
-    processing_tasks.add(file_id)
+    started = time.monotonic()
     
     try:
-        if is_video(file.filename):
+        # ffmpeg 启动前先创建进度文件，否则 /progress 在质量采样期间会因文件不存在而返回 100
+        sampling = is_video(filename) and options["quality_mode"]
+        with open(progress_path, "w") as f:
+            f.write("stage=sampling\n" if sampling else "")
+        
+        if is_video(filename):
             compressed_video = os.path.join(OUTPUT_DIR, file_id + "_compressed.mp4")
-            await compress_video_async(input_path, compressed_video, progress_path)
+            output_path = partial_path(compressed_video)
+            crf = DEFAULT_CRF
+            if options["quality_mode"]:
+                ffmpeg_cmd = await find_ffmpeg()
+                if ffmpeg_cmd:
+                    crf, score = await choose_crf(ffmpeg_cmd, input_path, options["quality_target"],
+                                                  options["quality_metric"], file_id)
+                    result["crf"] = crf
+                    result["quality_score"] = score
+            job_profile = {"crf": crf, "quality_mode": options["quality_mode"]}
+            await compress_video_async(input_path, output_path, progress_path, file_id, crf=crf)
+            commit_output(output_path, compressed_video)
             result["video"] = f"/download/{os.path.basename(compressed_video)}"
+            result["preview"] = f"/preview/{os.path.basename(compressed_video)}"
+            result["faststart"] = verify_faststart(compressed_video)
             result["size"] = os.path.getsize(compressed_video)
             result["original_size"] = os.path.getsize(input_path)
-        elif is_audio(file.filename):
-            compressed_audio = os.path.join(OUTPUT_DIR, file_id + "_compressed.mp3")
-            await compress_audio_async(input_path, compressed_audio, progress_path) 
+        elif is_audio(filename):
+            ffmpeg_cmd = await find_ffmpeg()
+            if not ffmpeg_cmd:
+                raise HTTPException(status_code=503, detail="音频处理服务暂时不可用，正在维护中")
+            profile = await plan_audio(ffmpeg_cmd, input_path, options["audio_format"], options["audio_content"])
+            compressed_audio = os.path.join(OUTPUT_DIR, file_id + "_compressed" + profile["ext"])
+            output_path = partial_path(compressed_audio)
+            job_profile = {key: profile[key] for key in ("codec", "content", "bitrate", "channels", "sample_rate")}
+            job_profile["loudnorm"] = options["loudnorm"]
+            await compress_audio_async(input_path, output_path, progress_path, file_id,
+                                       profile=profile, loudnorm=options["loudnorm"])
+            commit_output(output_path, compressed_audio)
             result["audio"] = f"/download/{os.path.basename(compressed_audio)}"
+            result["audio_codec"] = profile["codec"]
+            result["audio_content"] = profile["content"]
             result["size"] = os.path.getsize(compressed_audio)
             result["original_size"] = os.path.getsize(input_path)
             
         logger.info(f"处理完成 - 任务ID: {file_id}, 原始大小: {result.get('original_size', 0)}, 压缩后: {result.get('size', 0)}")
+        succeeded = True
         
+    except JobCancelled:
+        failure = ("cancelled", "任务已取消")
+        logger.info(f"任务已取消 - 任务ID: {file_id}")
+        raise HTTPException(status_code=409, detail="任务已取消")
+    except HTTPException as e:
+        failure = ("failed", str(e.detail))
+        raise
     except subprocess.CalledProcessError as e:
+        failure = ("failed", f"ffmpeg 退出码 {e.returncode}")
         logger.error(f"FFmpeg 处理失败 - 任务ID: {file_id}, 错误: {e}")
         raise HTTPException(status_code=500, detail="文件处理失败，请检查文件格式")
-    except subprocess.TimeoutExpired:
+    except (subprocess.TimeoutExpired, asyncio.TimeoutError):
+        failure = ("timeout", "处理超时")
         logger.error(f"处理超时 - 任务ID: {file_id}")
         raise HTTPException(status_code=408, detail="处理超时，文件可能过大或过于复杂")
     except Exception as e:
+        failure = ("failed", f"{type(e).__name__}: {e}")
         logger.error(f"处理异常 - 任务ID: {file_id}, 错误: {e}")
         raise HTTPException(status_code=500, detail="服务器内部错误")
     finally:
-        # 从处理任务集合中移除
-        processing_tasks.discard(file_id)
+        # 释放并发名额，之后的相同上传将重新编码
+        if inflight.get(flight.key) is flight:
+            inflight.pop(flight.key)
+        await coordinated(job_coordinator, "release", file_id)
+        cancelled_tasks.discard(file_id)
+        
+        # 关闭服务时被中断的任务留在日志中，重启后重新排队
+        interrupted = shutting_down and not succeeded
+        if interrupted:
+            failure = ("interrupted", "服务重启时中断，重启后重新排队")
         
-        # 清理上传文件
+        # 记录任务结果
+        status, error = failure or (("success", None) if succeeded else ("failed", "未知错误"))
+        if succeeded:
+            await record_history_async(job_journal.complete, file_id, result)
+        elif not interrupted:
+            await record_history_async(job_journal.remove, file_id)
+        await record_history_async(
+            job_history.finish, file_id, status,
+            output_size=result.get("size"),
+            encode_seconds=round(time.monotonic() - started, 3),
+            profile=job_profile or None,
+            error=error,
+            **read_progress_stats(progress_path)
+        )
+        
+        # 失败或取消时清理不完整的输出文件
+        if not succeeded and output_path:
+            try:
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+            except Exception as e:
+                logger.error(f"清理输出文件失败: {e}")
+        
+        # 清理上传文件（被中断的任务保留输入文件）
         try:
-            if os.path.exists(input_path):
+            if not interrupted and os.path.exists(input_path):
                 os.remove(input_path)
         except Exception as e:
             logger.error(f"清理上传文件失败: {e}")
@@ -335,10 +968,50 @@ async def upload_file(request: Request, file: UploadFile = File(...), task_id: s
         except Exception as e:
             logger.error(f"清理进度文件失败: {e}")
     
-    return JSONResponse(result)
+    return result
+
+@app.delete("/jobs/{task_id}")
+async def cancel_job(task_id: str, request: Request):
+    """取消任务：该请求立即退出等待；没有其他请求共享同一编码时终止 ffmpeg 进程树并释放名额
+
+    在事件循环中执行：等待者、取消集合和进程表都由事件循环维护，不能在线程池中修改。
+    """
+    # 不属于调用方的任务与不存在的任务返回相同结果，不暴露其他客户端的任务
+    if not await asyncio.get_running_loop().run_in_executor(None, may_cancel, request, task_id):
+        raise HTTPException(status_code=404, detail="任务不存在或已结束")
+    
+    flight = waiter_flights.get(task_id)
+    if flight is not None:
+        detached_waiters.add(task_id)
+        flight.waiters.pop(task_id, None)
+        abandon_flight_if_unwatched(flight)
+        logger.info(f"取消任务 - 任务ID: {task_id}")
+        return {"task_id": task_id, "status": "cancelled"}
+    
+    owned = next((f for f in inflight.values() if f.job_id == task_id), None)
+    if owned is not None:
+        # 重启后恢复的任务由提交者显式取消；仍有合并进来的请求在等待时继续编码
+        if owned.persistent:
+            owned.persistent = False
+            abandon_flight_if_unwatched(owned)
+            logger.info(f"取消任务 - 任务ID: {task_id}")
+            return {"task_id": task_id, "status": "cancelled"}
+        # 本 worker 上的编码仍有其他请求在等待，不能终止
+        raise HTTPException(status_code=404, detail="任务不存在或已结束")
+    
+    # 任务在其他 worker 上运行：设置共享取消标记，由运行它的 worker 在下一次轮询时终止并释放名额
+    if not await coordinated(job_coordinator, "request_cancel", task_id):
+        raise HTTPException(status_code=404, detail="任务不存在或已结束")
+    logger.info(f"取消任务 - 任务ID: {task_id}")
+    
+    return {"task_id": task_id, "status": "cancelled"}
 
 @app.get("/progress")
 def get_progress(task_id: str = Query(...)):
+    # 被合并的请求读取实际执行编码的任务的进度
+    flight = waiter_flights.get(task_id)
+    if flight is not None:
+        task_id = flight.job_id
     progress_path = os.path.join(OUTPUT_DIR, task_id + ".progress")
     if not os.path.exists(progress_path):
         return {"progress": 100}
@@ -346,6 +1019,10 @@ def get_progress(task_id: str = Query(...)):
         with open(progress_path, "r") as f:
             lines = f.readlines()
         percent = 0
+        # 质量目标模式下正式编码前的采样阶段，正式编码开始后 ffmpeg 写入进度
+        sampling = any(line.strip() == "stage=sampling" for line in lines)
+        if sampling and not any(line.startswith("out_time_ms") for line in lines):
+            return {"progress": 0, "stage": "sampling"}
         for line in lines:
             if line.startswith("out_time_ms"):  # ffmpeg进度
                 # 不能直接算百分比，简单用帧数/时长等，暂用80%模拟
@@ -362,6 +1039,10 @@ def download_file(request: Request, filename: str):
     if not filename or '..' in filename or '/' in filename or '\\' in filename:
         raise HTTPException(status_code=400, detail="无效的文件名")
     
+    # 尚未完成的输出文件不可下载
+    if is_partial(filename):
+        raise HTTPException(status_code=404, detail="文件不存在或已过期")
+    
     file_path = os.path.join(OUTPUT_DIR, filename)
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="文件不存在或已过期")
@@ -376,28 +1057,168 @@ def download_file(request: Request, filename: str):
         headers={"Cache-Control": "no-cache, no-store, must-revalidate"}
     )
 
+async def finish_preview_job(job_id: str, build: asyncio.Future, started: float, input_path: Optional[str]):
+    """预览生成结束后释放并发名额、记录历史；input_path 非空时删除上传的临时文件"""
+    await coordinated(job_coordinator, "release", job_id)
+    if build.cancelled():
+        status, error = "cancelled", "生成已取消"
+    elif build.exception() is not None:
+        e = build.exception()
+        status, error = "failed", f"{type(e).__name__}: {e}"
+    else:
+        status, error = "success", None
+    await record_history_async(job_history.finish, job_id, status,
+                               encode_seconds=round(time.monotonic() - started, 3), error=error)
+    if input_path and os.path.exists(input_path):
+        os.remove(input_path)
+
+async def build_preview_response(request: Request, input_path: str, filename: str, digest: str, fmt: str,
+                                 input_size: Optional[int] = None, remove_input: bool = False) -> dict:
+    """生成或复用预览；remove_input 为真时由本函数（或它启动的生成任务）负责删除 input_path"""
+    ffmpeg_cmd = await find_ffmpeg()
+    if not ffmpeg_cmd:
+        if remove_input and os.path.exists(input_path):
+            os.remove(input_path)
+        raise HTTPException(status_code=503, detail="预览服务暂时不可用，正在维护中")
+    
+    # 生成预览要运行三个 ffmpeg 进程：与压缩任务一样计入配额并占用并发名额。
+    # 只有真正启动新生成时才会调用 admit；名额和历史记录在生成任务结束时释放，
+    # 客户端中途断开时 ffmpeg 仍在运行，名额也一直占用到那时
+    client_ip = get_client_id(request)
+    handed_off = False
+    
+    async def admit():
+        nonlocal handed_off
+        job_id = f"preview-{uuid.uuid4()}"
+        within_quota, quota_msg = await asyncio.get_running_loop().run_in_executor(
+            None, job_history.reserve, job_id, client_ip, "preview", filename, input_size
+        )
+        if not within_quota:
+            logger.info(f"超出配额 - IP: {client_ip}, 原因: {quota_msg}")
+            raise HTTPException(status_code=429, detail=quota_msg)
+        if not await coordinated(job_coordinator, "try_acquire", job_id, "preview", MAX_CONCURRENT_TASKS):
+            await record_history_async(job_history.release, job_id)
+            raise HTTPException(status_code=429, detail="服务器繁忙，请稍后重试")
+        started = time.monotonic()
+        # 生成任务读取 input_path，删除交给它结束时处理
+        handed_off = remove_input
+        cleanup = input_path if remove_input else None
+        return lambda build: asyncio.ensure_future(finish_preview_job(job_id, build, started, cleanup))
+    
+    try:
+        key, manifest = await get_preview(ffmpeg_cmd, input_path, digest, fmt, admit=admit,
+                                          runner=functools.partial(run_ffmpeg, timeout=PREVIEW_TIMEOUT))
+    except (RuntimeError, asyncio.TimeoutError) as e:
+        logger.error(f"生成预览失败 - 文件: {filename}, 错误: {e}")
+        raise HTTPException(status_code=500, detail="生成预览失败，请检查文件格式")
+    finally:
+        if remove_input and not handed_off and os.path.exists(input_path):
+            os.remove(input_path)
+    return preview_response(key, manifest)
+
+@app.post("/preview")
+async def preview_upload(request: Request, file: UploadFile = File(...), format: str = Query("webp")):
+    """上传视频生成缩略图精灵图、封面和预览片段（按内容缓存，不做压缩）"""
+    if not file.filename or not is_video(file.filename):
+        raise HTTPException(status_code=400, detail="只支持视频文件预览")
+    if format not in SPRITE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"不支持的图片格式: {format}")
+    if hasattr(file, 'size') and file.size and file.size > FILE_SIZE_LIMIT:
+        raise HTTPException(status_code=413, detail=f"文件过大，最大支持 {FILE_SIZE_LIMIT//1024//1024}MB")
+    
+    ensure_dirs()
+    input_path = os.path.join(UPLOAD_DIR, f"preview-{uuid.uuid4()}{os.path.splitext(file.filename)[-1]}")
+    try:
+        digest = await asyncio.get_running_loop().run_in_executor(None, save_upload, file, input_path)
+    except BaseException:
+        if os.path.exists(input_path):
+            os.remove(input_path)
+        raise
+    return await build_preview_response(request, input_path, file.filename, digest, format,
+                                        os.path.getsize(input_path), remove_input=True)
+
+@app.get("/preview/{filename}")
+async def preview_output(request: Request, filename: str, format: str = Query("webp")):
+    """压缩结果的预览，用户无需下载整个文件即可确认内容"""
+    if not filename or '..' in filename or '/' in filename or '\\' in filename or is_partial(filename):
+        raise HTTPException(status_code=400, detail="无效的文件名")
+    if not is_video(filename):
+        raise HTTPException(status_code=400, detail="只支持视频文件预览")
+    if format not in SPRITE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"不支持的图片格式: {format}")
+    
+    file_path = os.path.join(OUTPUT_DIR, filename)
+    if not os.path.exists(file_path):
+        raise HTTPException(status_code=404, detail="文件不存在或已过期")
+    digest = await asyncio.get_running_loop().run_in_executor(None, file_digest, file_path)
+    return await build_preview_response(request, file_path, filename, digest, format)
+
+@app.get("/preview/assets/{key}/{name}")
+def preview_asset(key: str, name: str):
+    """预览文件按内容寻址，内容不会变化，可长期缓存"""
+    if not re.fullmatch(r"[0-9a-f]{64}-(webp|jpg)", key) or not re.fullmatch(r"[a-z]+\.(webp|jpg|mp4)", name):
+        raise HTTPException(status_code=400, detail="无效的文件名")
+    path = preview_cache.asset_path(key, name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="预览不存在或已过期")
+    return FileResponse(
+        path,
+        media_type=asset_media_type(name),
+        headers={"Cache-Control": "public, max-age=86400, immutable"}
+    )
+
 # 健康检查端点
 @app.get("/health")
 def health_check():
     return {
         "status": "healthy",
-        "processing_tasks": len(processing_tasks),
-        "max_tasks": MAX_CONCURRENT_TASKS
+        "processing_tasks": job_coordinator.active_count(),
+        "max_tasks": MAX_CONCURRENT_TASKS,
+        "shared_state": job_coordinator.shared,
+        "worker_pid": os.getpid()
     }
 
+@app.get("/jobs/active", dependencies=[Depends(require_admin)])
+def list_active_jobs():
+    """所有 worker 上正在处理的任务"""
+    return {"jobs": job_coordinator.list_active()}
+
+@app.get("/jobs", dependencies=[Depends(require_admin)])
+def list_jobs(status: Optional[str] = Query(None), client: Optional[str] = Query(None),
+              hours: Optional[float] = Query(None, gt=0), limit: int = Query(50, ge=1, le=500),
+              offset: int = Query(0, ge=0)):
+    """查询任务历史"""
+    since = time.time() - hours * 3600 if hours else None
+    return {"jobs": job_history.list(status, client, since, limit, offset)}
+
+@app.get("/jobs/stats", dependencies=[Depends(require_admin)])
+def job_stats(hours: float = Query(24, gt=0)):
+    """按时间窗口汇总任务统计，用于容量规划"""
+    return {"hours": hours, **job_history.stats(time.time() - hours * 3600)}
+
+@app.get("/jobs/{task_id}")
+def get_job(task_id: str):
+    """查询单个任务的处理记录；重启后恢复的任务完成时附带处理结果（下载地址等）"""
+    job = job_history.get(task_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    job.pop("client", None)
+    entry = job_journal.get(task_id)
+    if entry and entry.get("result"):
+        job["result"] = entry["result"]
+    return job
+
+@app.get("/startup-report")
+def startup_report():
+    """冷启动各阶段耗时"""
+    return startup_profile.report()
+
 # FFmpeg 可用性检查端点
 @app.get("/ffmpeg-status")
 async def ffmpeg_status():
     """检查 FFmpeg 是否可用"""
-    ffmpeg_paths = [
-        "ffmpeg",
-        "/usr/bin/ffmpeg", 
-        "/opt/ffmpeg/bin/ffmpeg",
-        "/usr/local/bin/ffmpeg"
-    ]
-    
     available_paths = []
-    for path in ffmpeg_paths:
+    for path in FFMPEG_PATHS:
         try:
             process = await asyncio.create_subprocess_exec(
                 path, "-version",
@@ -417,8 +1238,10 @@ async def ffmpeg_status():
     return {
         "ffmpeg_available": len(available_paths) > 0,
         "available_paths": available_paths,
-        "checked_paths": ffmpeg_paths
+        "checked_paths": FFMPEG_PATHS
     }
 
 # FastAPI 应用导出（用于 Vercel ASGI）
-# app 变量已经在上面定义，Vercel 会自动识别
\ No newline at end of file
+# app 变量已经在上面定义，Vercel 会自动识别
+
+startup_profile.record("module_init", _import_started)
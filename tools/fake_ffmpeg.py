@@ -0,0 +1,306 @@
+"""ffmpeg / ffprobe 替身：不做真实编码，只模拟耗时、CPU 占用和 -progress 输出
+
+压力测试时由 tools/loadtest.py 生成名为 ffmpeg、ffprobe 的包装脚本放到 PATH 最前面，
+服务端照常启动子进程、轮询进度、取消和清理，但编码耗时可控，便于把排队、准入和进度
+推送的开销与编解码时间分开测量。也可以单独使用：
+
+    python tools/fake_ffmpeg.py ffmpeg -y -i in.mp4 -progress p.txt out.mp4
+    python tools/fake_ffmpeg.py ffprobe -of json -show_entries format=duration in.mp4
+
+输入文件若以 FAKEMEDIA 头开头（见 media_header），时长、分辨率、声道等从头部读取；
+否则按 1Mbps 由文件大小估算时长。行为通过环境变量调整：
+
+    FAKE_FFMPEG_SPEED=8             编码速度（相对实时的倍数）
+    FAKE_FFMPEG_CPU=0.0             模拟的 CPU 占用（单核比例，0~1）
+    FAKE_FFMPEG_RATIO=0.35          输出大小 / 输入大小
+    FAKE_FFMPEG_FAIL_RATE=0.0       随机失败的比例
+    FAKE_FFMPEG_STARTUP=0.05        进程启动与编码器初始化耗时（秒）
+    FAKE_FFMPEG_PROGRESS_PERIOD=0.5 -progress 输出间隔（秒，与 ffmpeg 默认 stats_period 一致）
+    FAKE_FFMPEG_LOG=/path/log.jsonl 每次调用追加一行 JSON（输入、输出、起止时间、退出码）
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import struct
+
+HEADER_MAGIC = b"FAKEMEDIA "
+DEFAULT_BITRATE = 1_000_000  # 无头部时估算时长用的码率（bit/s）
+SINGLE_FRAME_BYTES = 60 * 1024
+
+SPEED = float(os.environ.get("FAKE_FFMPEG_SPEED", "8"))
+CPU = min(max(float(os.environ.get("FAKE_FFMPEG_CPU", "0")), 0.0), 1.0)
+RATIO = float(os.environ.get("FAKE_FFMPEG_RATIO", "0.35"))
+FAIL_RATE = float(os.environ.get("FAKE_FFMPEG_FAIL_RATE", "0"))
+STARTUP = float(os.environ.get("FAKE_FFMPEG_STARTUP", "0.05"))
+PROGRESS_PERIOD = float(os.environ.get("FAKE_FFMPEG_PROGRESS_PERIOD", "0.5"))
+LOG_PATH = os.environ.get("FAKE_FFMPEG_LOG")
+
+ENCODERS = [
+    ("V....D", "libx264", "libx264 H.264 / AVC / MPEG-4 AVC"),
+    ("V....D", "libwebp", "libwebp WebP image"),
+    ("V....D", "mjpeg", "MJPEG (Motion JPEG)"),
+    ("A....D", "aac", "AAC (Advanced Audio Coding)"),
+    ("A....D", "libopus", "libopus Opus"),
+    ("A....D", "libmp3lame", "libmp3lame MP3 (MPEG audio layer 3)"),
+]
+FILTERS = ["scale", "select", "tile", "pad", "setpts", "ssim", "psnr", "loudnorm"]
+
+# 不带参数的选项；其余以 - 开头的选项都消耗下一个参数
+FLAGS = {"-y", "-n", "-hide_banner", "-nostats", "-an", "-vn", "-sn", "-dn", "-version",
+         "-encoders", "-filters", "-shortest"}
+
+
+def media_header(**info) -> bytes:
+    """生成 FAKEMEDIA 头部（压力测试构造上传文件时使用）"""
+    return HEADER_MAGIC + json.dumps(info, sort_keys=True).encode() + b"\n"
+
+
+def read_media_info(path: str) -> dict:
+    """读取输入文件的模拟媒体信息"""
+    try:
+        size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            first = f.readline(4096)
+    except OSError:
+        return {}
+    info = {}
+    if first.startswith(HEADER_MAGIC):
+        try:
+            info = json.loads(first[len(HEADER_MAGIC):])
+        except ValueError:
+            info = {}
+    info.setdefault("duration", max(size * 8 / DEFAULT_BITRATE, 0.1))
+    info.setdefault("kind", "video" if path.lower().endswith((".mp4", ".mov", ".mkv", ".avi", ".webm")) else "audio")
+    info["size"] = size
+    return info
+
+
+def parse_args(argv: list) -> dict:
+    """粗略解析 ffmpeg 命令行：输入、输出、-ss/-t、-progress 及滤镜"""
+    parsed = {"inputs": [], "outputs": [], "progress": None, "t": None,
+              "filters": "", "movflags": ""}
+    pending_ss, pending_t = 0.0, None
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg in FLAGS:
+            i += 1
+            continue
+        if arg.startswith("-") and arg != "-" and i + 1 < len(argv):
+            value = argv[i + 1]
+            if arg == "-i":
+                parsed["inputs"].append((value, pending_ss, pending_t))
+                pending_ss, pending_t = 0.0, None
+            elif arg == "-ss":
+                pending_ss = float(value)
+            elif arg == "-t":
+                pending_t = float(value)
+            elif arg == "-progress":
+                parsed["progress"] = value
+            elif arg in ("-vf", "-lavfi", "-filter_complex", "-af"):
+                parsed["filters"] += value + ";"
+            elif arg == "-movflags":
+                parsed["movflags"] += value
+            i += 2
+            continue
+        parsed["outputs"].append(arg)
+        # 输出前的 -t 作用于该输出
+        if pending_t is not None:
+            parsed["t"] = pending_t if parsed["t"] is None else max(parsed["t"], pending_t)
+            pending_t = None
+        i += 1
+    return parsed
+
+
+def mp4_bytes(size: int, faststart: bool) -> bytes:
+    """最小的 MP4 顶层结构：ftyp + moov + mdat（或 mdat 在前），便于服务端校验 faststart"""
+    ftyp = struct.pack(">I4s", 16, b"ftyp") + b"isom\x00\x00\x02\x00"
+    moov = struct.pack(">I4s", 16, b"moov") + b"\x00" * 8
+    payload = max(size - len(ftyp) - len(moov) - 8, 0)
+    mdat = struct.pack(">I4s", payload + 8, b"mdat") + b"\x00" * payload
+    return ftyp + (moov + mdat if faststart else mdat + moov)
+
+
+def write_output(path: str, size: int, movflags: str):
+    if path == "-" or path.startswith("pipe:"):
+        return
+    size = max(size, 64)
+    if path.endswith((".mp4", ".m4a", ".mov")):
+        data = mp4_bytes(size, "faststart" in movflags or "empty_moov" in movflags)
+    else:
+        data = HEADER_MAGIC + b"{}\n" + b"\x00" * size
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def progress_block(media_seconds: float, elapsed: float, frame_rate: float, out_bytes: int, done: bool) -> str:
+    us = int(media_seconds * 1_000_000)
+    hours, rest = divmod(media_seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    speed = media_seconds / elapsed if elapsed > 0 else 0.0
+    return (
+        f"frame={int(media_seconds * frame_rate)}\n"
+        f"fps={(media_seconds * frame_rate / elapsed) if elapsed > 0 else 0:.2f}\n"
+        "stream_0_0_q=28.0\n"
+        f"bitrate={(out_bytes * 8 / 1000 / media_seconds) if media_seconds else 0:.1f}kbits/s\n"
+        f"total_size={out_bytes}\n"
+        f"out_time_us={us}\n"
+        f"out_time_ms={us}\n"
+        f"out_time={int(hours):02d}:{int(minutes):02d}:{seconds:09.6f}\n"
+        "dup_frames=0\n"
+        "drop_frames=0\n"
+        f"speed={speed:.3g}x\n"
+        f"progress={'end' if done else 'continue'}\n"
+    )
+
+
+def simulate(seconds: float, on_tick):
+    """按 PROGRESS_PERIOD 推进模拟编码，每个周期内按 CPU 比例空转"""
+    started = time.monotonic()
+    while True:
+        elapsed = time.monotonic() - started
+        if elapsed >= seconds:
+            return
+        tick = min(PROGRESS_PERIOD, seconds - elapsed)
+        busy_until = time.monotonic() + tick * CPU
+        while time.monotonic() < busy_until:
+            pass
+        time.sleep(max(tick * (1 - CPU), 0))
+        on_tick(min(time.monotonic() - started, seconds))
+
+
+def quality_line(parsed: dict) -> str:
+    """质量评分：按试编码文件名中的 CRF 给出单调递减的分数"""
+    crf = 32
+    for path, _, _ in parsed["inputs"]:
+        match = re.search(r"crf(\d+)", os.path.basename(path))
+        if match:
+            crf = int(match.group(1))
+    filters = parsed["filters"]
+    if "libvmaf" in filters:
+        return f"[libvmaf @ 0x0] VMAF score: {max(100 - (crf - 18) * 2.5, 0):.6f}\n"
+    if "psnr" in filters:
+        return f"[Parsed_psnr_2 @ 0x0] PSNR y:40 u:42 v:42 average:{48 - (crf - 18) * 0.8:.6f} min:30 max:50\n"
+    if "ssim" in filters:
+        return f"[Parsed_ssim_2 @ 0x0] SSIM Y:0.97 U:0.98 V:0.98 All:{1 - (crf - 18) * 0.006:.6f} (20.0)\n"
+    return ""
+
+
+def run_ffmpeg(argv: list) -> int:
+    if "-version" in argv:
+        print("ffmpeg version 6.1-fake Copyright (c) 2000-2023 the FFmpeg developers")
+        return 0
+    if "-encoders" in argv:
+        print("Encoders:\n ------")
+        for flags, name, description in ENCODERS:
+            print(f" {flags} {name:<20} {description}")
+        return 0
+    if "-filters" in argv:
+        print("Filters:\n  ------")
+        names = FILTERS + (["libvmaf"] if os.environ.get("FAKE_FFMPEG_VMAF") == "1" else [])
+        for name in names:
+            print(f" ... {name:<16} V->V       {name}")
+        return 0
+
+    parsed = parse_args(argv)
+    infos = [(read_media_info(path), ss, t) for path, ss, t in parsed["inputs"]]
+    if not infos or any(not info for info, _, _ in infos):
+        sys.stderr.write("No such file or directory\n")
+        return 1
+
+    # 只读关键帧的缩略图、单帧输出几乎不耗时；多输入的评分按最长输入计
+    media_seconds = 0.0
+    for info, ss, t in infos:
+        span = max(info["duration"] - ss, 0.0)
+        if t is not None:
+            span = min(span, t)
+        if parsed["t"] is not None:
+            span = min(span, parsed["t"])
+        media_seconds = max(media_seconds, span) if len(parsed["outputs"]) == 1 else media_seconds + span
+    if "-skip_frame" in argv or "-frames:v" in argv:
+        media_seconds = min(media_seconds, 0.5)
+    seconds = STARTUP + media_seconds / SPEED
+    frame_rate = float(infos[0][0].get("fps", 30))
+    total_in = sum(info["size"] for info, _, _ in infos)
+
+    def on_tick(elapsed: float):
+        if parsed["progress"]:
+            done_media = media_seconds * min(elapsed / seconds, 1.0)
+            with open(parsed["progress"], "a") as f:
+                f.write(progress_block(done_media, elapsed, frame_rate, int(total_in * RATIO * elapsed / seconds), False))
+
+    if random.random() < FAIL_RATE:
+        simulate(seconds * random.random(), on_tick)
+        sys.stderr.write(f"{parsed['inputs'][0][0]}: Invalid data found when processing input\n")
+        return 1
+
+    simulate(seconds, on_tick)
+    share = total_in * RATIO / max(len(parsed["outputs"]), 1)
+    if "-frames:v" in argv:
+        # 缩略图、封面等单帧图片只有几十 KB
+        share = min(share, SINGLE_FRAME_BYTES)
+    for output in parsed["outputs"]:
+        write_output(output, int(share), parsed["movflags"])
+    if parsed["progress"]:
+        with open(parsed["progress"], "a") as f:
+            f.write(progress_block(media_seconds, seconds, frame_rate, int(total_in * RATIO), True))
+    sys.stderr.write(quality_line(parsed))
+    return 0
+
+
+def run_ffprobe(argv: list) -> int:
+    path = argv[-1]
+    info = read_media_info(path)
+    if not info:
+        sys.stderr.write(f"{path}: No such file or directory\n")
+        return 1
+    bit_rate = int(info["size"] * 8 / info["duration"])
+    if "-of" in argv and argv[argv.index("-of") + 1].startswith("default"):
+        print(f"{info['duration']:.6f}")
+        return 0
+    selected = argv[argv.index("-select_streams") + 1] if "-select_streams" in argv else "v:0"
+    if selected.startswith("a"):
+        channels = info.get("channels", 2)
+        stream = {
+            "codec_name": info.get("codec", "aac"),
+            "channels": channels,
+            "channel_layout": "mono" if channels == 1 else "stereo",
+            "sample_rate": str(info.get("sample_rate", 44100)),
+            "bit_rate": str(info.get("audio_bitrate", bit_rate)),
+        }
+    else:
+        if info["kind"] != "video":
+            stream = None
+        else:
+            stream = {"width": info.get("width", 1920), "height": info.get("height", 1080)}
+    print(json.dumps({
+        "streams": [stream] if stream else [],
+        "format": {"duration": f"{info['duration']:.6f}", "bit_rate": str(bit_rate)},
+    }))
+    return 0
+
+
+def main() -> int:
+    mode, argv = sys.argv[1], sys.argv[2:]
+    started = time.time()
+    returncode = run_ffprobe(argv) if mode == "ffprobe" else run_ffmpeg(argv)
+    if LOG_PATH and mode == "ffmpeg" and "-i" in argv:
+        parsed = parse_args(argv)
+        record = {
+            "pid": os.getpid(),
+            "inputs": [path for path, _, _ in parsed["inputs"]],
+            "outputs": parsed["outputs"],
+            "started": started,
+            "finished": time.time(),
+            "returncode": returncode,
+        }
+        with open(LOG_PATH, "a") as f:
+            f.write(json.dumps(record) + "\n")
+    return returncode
+
+
+if __name__ == "__main__":
+    sys.exit(main())
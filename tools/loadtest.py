@@ -0,0 +1,541 @@
+"""压力测试：在进程内按真实流量特征回放上传请求，测量排队、准入和进度推送的开销
+
+编码由 tools/fake_ffmpeg.py 模拟（可调速度和 CPU 占用），服务端的并发名额、429、
+取消、进度文件和临时文件清理逻辑都照常运行。每个编码进程的起止时间记录在日志中，
+按任务 ID 关联后，请求耗时被拆成「编码时间」与「编码以外的开销」（排队、准入、保存上传、
+收尾等）。
+
+    python tools/loadtest.py --app main --duration 60 --rate 2
+    python tools/loadtest.py --app index --mix audio-batch --rate 1 --burst-factor 6
+    python tools/loadtest.py --app main --ffmpeg-dir /usr/bin   # 使用真实 ffmpeg
+
+需要安装 requirements.txt 中的依赖（fastapi、python-multipart）。
+"""
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import importlib
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_FFMPEG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_ffmpeg.py")
+sys.path.insert(0, os.path.dirname(FAKE_FFMPEG))
+from fake_ffmpeg import media_header  # noqa: E402
+
+APPS = {
+    # 名称 -> (模块, 上传字段名, 是否支持 /progress 与 DELETE /jobs)
+    "main": ("api.main", "file", True),
+    "index": ("api.index", "files", False),
+}
+
+# 流量组成：权重、类型、大小分布（对数正态，中位数 MB 与 sigma）、码率与上传参数
+TRAFFIC_MIXES = {
+    "default": [
+        {"name": "phone-video", "weight": 5, "kind": "video", "ext": ".mp4", "size_mb": (8, 0.7),
+         "bitrate_kbps": 6000, "media": {"width": 1080, "height": 1920, "fps": 30}},
+        {"name": "screen-recording", "weight": 2, "kind": "video", "ext": ".mov", "size_mb": (20, 0.4),
+         "bitrate_kbps": 2500, "media": {"width": 1920, "height": 1080, "fps": 30}},
+        {"name": "quality-video", "weight": 1, "kind": "video", "ext": ".mp4", "size_mb": (6, 0.5),
+         "bitrate_kbps": 5000, "media": {"width": 1920, "height": 1080, "fps": 30},
+         "params": {"quality_mode": "true"}},
+        {"name": "voice-memo", "weight": 4, "kind": "audio", "ext": ".m4a", "size_mb": (0.8, 0.8),
+         "bitrate_kbps": 64, "media": {"channels": 1, "sample_rate": 16000, "codec": "aac"}},
+        {"name": "music", "weight": 2, "kind": "audio", "ext": ".mp3", "size_mb": (6, 0.4),
+         "bitrate_kbps": 256, "media": {"channels": 2, "sample_rate": 44100, "codec": "mp3"},
+         "params": {"loudnorm": "true"}},
+        {"name": "oversize", "weight": 0.2, "kind": "video", "ext": ".mp4", "size_mb": (70, 0.1),
+         "bitrate_kbps": 8000, "media": {"width": 3840, "height": 2160, "fps": 30}},
+    ],
+    "audio-batch": [
+        {"name": "voice-batch", "weight": 3, "kind": "audio", "ext": ".m4a", "size_mb": (0.5, 0.6),
+         "bitrate_kbps": 48, "media": {"channels": 1, "sample_rate": 16000, "codec": "aac"}, "files": 5},
+        {"name": "music-batch", "weight": 1, "kind": "audio", "ext": ".mp3", "size_mb": (4, 0.3),
+         "bitrate_kbps": 192, "media": {"channels": 2, "sample_rate": 44100, "codec": "mp3"}, "files": 3},
+        {"name": "voice-memo", "weight": 2, "kind": "audio", "ext": ".m4a", "size_mb": (0.8, 0.8),
+         "bitrate_kbps": 64, "media": {"channels": 1, "sample_rate": 16000, "codec": "aac"}},
+    ],
+    "video-only": [
+        {"name": "phone-video", "weight": 1, "kind": "video", "ext": ".mp4", "size_mb": (8, 0.7),
+         "bitrate_kbps": 6000, "media": {"width": 1080, "height": 1920, "fps": 30}},
+    ],
+}
+
+MAX_PAYLOAD_MB = 80  # 构造上传文件的大小上限，避免占用过多内存
+
+
+# ---------------------------------------------------------------- 环境准备
+
+def prepare_environment(args) -> str:
+    """创建 ffmpeg/ffprobe 包装脚本并设置服务端环境变量，必须在导入应用之前调用"""
+    work_dir = tempfile.mkdtemp(prefix="loadtest-")
+    if args.ffmpeg_dir:
+        bin_dir = args.ffmpeg_dir
+    else:
+        bin_dir = os.path.join(work_dir, "bin")
+        os.makedirs(bin_dir)
+        for tool in ("ffmpeg", "ffprobe"):
+            path = os.path.join(bin_dir, tool)
+            with open(path, "w") as f:
+                f.write(f'#!/bin/sh\nexec "{sys.executable}" "{args.fake_ffmpeg}" {tool} "$@"\n')
+            os.chmod(path, 0o755)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ.get("PATH", "")
+    os.environ.update({
+        "FAKE_FFMPEG_SPEED": str(args.speed),
+        "FAKE_FFMPEG_CPU": str(args.cpu),
+        "FAKE_FFMPEG_FAIL_RATE": str(args.fail_rate),
+        "FAKE_FFMPEG_LOG": os.path.join(work_dir, "ffmpeg.jsonl"),
+        "JOB_HISTORY_DB": os.path.join(work_dir, "jobs.db"),
+        "JOB_JOURNAL_DB": os.path.join(work_dir, "journal.db"),
+        "PREVIEW_DIR": os.path.join(work_dir, "previews"),
+        "WARM_WORKERS": "0",
+    })
+    if args.no_quota:
+        for name in ("QUOTA_ACTIVE_PER_CLIENT", "QUOTA_JOBS_PER_HOUR", "QUOTA_BYTES_PER_HOUR"):
+            os.environ[name] = "0"
+    return work_dir
+
+
+def load_app(name: str, work_dir: str):
+    """导入应用，并把它的上传和输出目录指向本次测试的工作目录"""
+    sys.path.insert(0, ROOT)
+    module = importlib.import_module(APPS[name][0])
+    # 两个应用都在运行时读取模块级的目录变量，导入后替换即可，不会碰到 /tmp 下已有的文件
+    module.UPLOAD_DIR = os.path.join(work_dir, "uploads")
+    module.OUTPUT_DIR = os.path.join(work_dir, "outputs")
+    return module, module.app
+
+
+# ---------------------------------------------------------------- 进程内 ASGI 客户端
+
+class LifespanManager:
+    """按 ASGI lifespan 协议启动和关闭应用（兼容 lifespan 参数与 on_event 两种写法）"""
+
+    def __init__(self, app):
+        self.app = app
+        self.inbox: asyncio.Queue = asyncio.Queue()
+        self.outbox: asyncio.Queue = asyncio.Queue()
+        self.task: Optional[asyncio.Task] = None
+
+    async def __aenter__(self):
+        self.task = asyncio.ensure_future(
+            self.app({"type": "lifespan", "asgi": {"version": "3.0"}}, self.inbox.get, self.outbox.put)
+        )
+        await self.inbox.put({"type": "lifespan.startup"})
+        message = await self.outbox.get()
+        if message["type"] != "lifespan.startup.complete":
+            raise RuntimeError(f"应用启动失败: {message}")
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.inbox.put({"type": "lifespan.shutdown"})
+        await self.outbox.get()
+        await self.task
+
+
+async def asgi_request(app, method: str, path: str, query: str = "", headers: Optional[list] = None,
+                       body: bytes = b"", client: str = "127.0.0.1", chunk_size: int = 1024 * 1024,
+                       disconnect: Optional[asyncio.Event] = None) -> tuple:
+    """直接调用 ASGI 应用，返回 (状态码, 响应体)；disconnect 被设置时模拟客户端断开"""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": [(b"host", b"localhost")] + [(k.encode(), v.encode()) for k, v in (headers or [])],
+        "client": (client, 50000),
+        "server": ("localhost", 80),
+    }
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)] or [b""]
+    response_done = asyncio.Event()
+    disconnect = disconnect or asyncio.Event()
+    status = None
+    response_body = []
+
+    async def receive():
+        if chunks:
+            chunk = chunks.pop(0)
+            return {"type": "http.request", "body": chunk, "more_body": bool(chunks)}
+        # 请求体已发完：客户端已断开或响应已结束时立即返回断开消息，否则等待其中之一
+        if not (disconnect.is_set() or response_done.is_set()):
+            waiters = [asyncio.ensure_future(response_done.wait()), asyncio.ensure_future(disconnect.wait())]
+            try:
+                await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for waiter in waiters:
+                    waiter.cancel()
+                await asyncio.gather(*waiters, return_exceptions=True)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            response_body.append(message.get("body", b""))
+            if not message.get("more_body"):
+                response_done.set()
+
+    await app(scope, receive, send)
+    return status, b"".join(response_body)
+
+
+def multipart(field: str, files: List[tuple]) -> tuple:
+    """编码 multipart/form-data，files 为 [(文件名, 内容)]"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for filename, content in files:
+        parts.append(
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"{field}\"; filename=\"{filename}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n".encode() + content + b"\r\n"
+        )
+    parts.append(f"--{boundary}--\r\n".encode())
+    return f"multipart/form-data; boundary={boundary}", b"".join(parts)
+
+
+# ---------------------------------------------------------------- 流量生成
+
+class TrafficModel:
+    """马尔可夫调制泊松到达：平时按 rate，突发期间按 rate × burst_factor"""
+
+    def __init__(self, args, rng: random.Random):
+        self.args = args
+        self.rng = rng
+        self.mix = TRAFFIC_MIXES[args.mix]
+        self.weights = [profile["weight"] for profile in self.mix]
+        # 少数客户端贡献大部分流量（Zipf 分布），用于触发按客户端的配额
+        self.clients = [f"10.0.{i // 250}.{i % 250 + 1}" for i in range(args.clients)]
+        self.client_weights = [1 / (rank + 1) for rank in range(args.clients)]
+        self.recent_payloads: List[tuple] = []
+
+    def arrivals(self):
+        """生成到达时间（相对开始的秒数）"""
+        t, bursting = 0.0, False
+        next_switch = self.rng.expovariate(1 / self.args.burst_every) if self.args.burst_every else math.inf
+        while t < self.args.duration:
+            rate = self.args.rate * (self.args.burst_factor if bursting else 1)
+            t += self.rng.expovariate(rate)
+            while t >= next_switch:
+                bursting = not bursting
+                mean = self.args.burst_seconds if bursting else self.args.burst_every
+                next_switch += self.rng.expovariate(1 / mean)
+            if t < self.args.duration:
+                yield t, bursting
+
+    def make_request(self) -> dict:
+        profile = self.rng.choices(self.mix, self.weights)[0]
+        client = self.rng.choices(self.clients, self.client_weights)[0]
+        if self.recent_payloads and self.rng.random() < self.args.duplicate_rate:
+            # 重复上传：同一内容、同一参数，用于观察请求合并
+            profile, files = self.rng.choice(self.recent_payloads)
+            duplicate = True
+        else:
+            files = [self.make_file(profile) for _ in range(profile.get("files", 1))]
+            self.recent_payloads = (self.recent_payloads + [(profile, files)])[-20:]
+            duplicate = False
+        return {"profile": profile, "client": client, "files": files, "duplicate": duplicate}
+
+    def make_file(self, profile: dict) -> tuple:
+        median, sigma = profile["size_mb"]
+        size = int(min(self.rng.lognormvariate(math.log(median), sigma), MAX_PAYLOAD_MB) * 1024 * 1024)
+        duration = size * 8 / (profile["bitrate_kbps"] * 1000)
+        header = media_header(kind=profile["kind"], duration=round(duration, 3),
+                              nonce=uuid.uuid4().hex, **profile["media"])
+        return f"{profile['name']}-{uuid.uuid4().hex[:8]}{profile['ext']}", header + b"\0" * max(size - len(header), 0)
+
+
+# ---------------------------------------------------------------- 单个请求
+
+async def run_client(app, app_name: str, spec: dict, offset: float, bursting: bool, args,
+                     rng: random.Random) -> dict:
+    field, has_progress = APPS[app_name][1], APPS[app_name][2]
+    task_id = uuid.uuid4().hex
+    content_type, body = multipart(field, spec["files"])
+    params = {"task_id": task_id, **spec["profile"].get("params", {})}
+    query = "&".join(f"{k}={v}" for k, v in params.items())
+    record = {
+        "task_id": task_id,
+        "profile": spec["profile"]["name"],
+        "client": spec["client"],
+        "bytes": len(body),
+        "offset": round(offset, 3),
+        "bursting": bursting,
+        "duplicate": spec["duplicate"],
+        "cancelled": None,
+        "progress_polls": 0,
+        "progress_latency": [],
+        "first_progress": None,
+    }
+    disconnect = asyncio.Event()
+    started = time.monotonic()
+    done = asyncio.Event()
+
+    async def poll_progress():
+        while not done.is_set():
+            await asyncio.sleep(args.poll_interval)
+            if done.is_set():
+                return
+            poll_started = time.monotonic()
+            status, payload = await api_request(app, "GET", "/progress", f"task_id={task_id}",
+                                                    client=spec["client"])
+            record["progress_latency"].append(time.monotonic() - poll_started)
+            record["progress_polls"] += 1
+            if status == 200 and record["first_progress"] is None and not done.is_set():
+                if 0 < json.loads(payload).get("progress", 0) < 100:
+                    record["first_progress"] = time.monotonic() - started
+
+    async def maybe_cancel():
+        if rng.random() >= args.cancel_rate:
+            return
+        await asyncio.sleep(rng.uniform(0.2, 3.0))
+        if done.is_set():
+            return
+        if rng.random() < 0.5:
+            record["cancelled"] = "delete"
+            await api_request(app, "DELETE", f"/jobs/{task_id}", client=spec["client"])
+        else:
+            record["cancelled"] = "disconnect"
+            disconnect.set()
+
+    helpers = []
+    if has_progress:
+        helpers = [asyncio.ensure_future(poll_progress()), asyncio.ensure_future(maybe_cancel())]
+    try:
+        status, payload = await asgi_request(
+            app, "POST", "/upload", query,
+            headers=[("content-type", content_type), ("x-forwarded-for", spec["client"])],
+            body=body, client=spec["client"], disconnect=disconnect
+        )
+    finally:
+        done.set()
+        for helper in helpers:
+            helper.cancel()
+    record["latency"] = time.monotonic() - started
+    record["status"] = status
+    try:
+        data = json.loads(payload) if payload else {}
+    except ValueError:
+        data = {}
+    record["coalesced"] = bool(isinstance(data, dict) and data.get("coalesced"))
+    return record
+
+
+async def api_request(app, method: str, path: str, query: str = "", client: str = "127.0.0.1") -> tuple:
+    return await asgi_request(app, method, path, query, headers=[("x-forwarded-for", client)], client=client)
+
+
+# ---------------------------------------------------------------- 统计
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(int(round(q / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def summarize(values: List[float]) -> dict:
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p90": percentile(values, 90),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+def encode_spans(log_path: str) -> Dict[str, List[tuple]]:
+    """读取 fake ffmpeg 日志，返回 任务ID片段 -> [(开始, 结束)]（按输入/输出路径中的文件名关联）"""
+    spans = defaultdict(list)
+    if not os.path.exists(log_path):
+        return spans
+    with open(log_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            for path in record["inputs"] + record["outputs"]:
+                name = os.path.basename(path)
+                spans[name].append((record["started"], record["finished"]))
+    return spans
+
+
+def union_length(intervals: List[tuple]) -> float:
+    total, current_start, current_end = 0.0, None, None
+    for start, end in sorted(intervals):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+
+def attach_encode_times(records: List[dict], log_path: str):
+    spans = encode_spans(log_path)
+    for record in records:
+        intervals = [span for name, items in spans.items() if record["task_id"] in name for span in items]
+        record["encode_seconds"] = union_length(intervals) if intervals else None
+        if record["encode_seconds"] is not None and record["status"] == 200:
+            record["overhead_seconds"] = max(record["latency"] - record["encode_seconds"], 0.0)
+
+
+def leftover_files(module) -> dict:
+    """测试结束后仍留在临时目录中的文件（检查清理逻辑）"""
+    leftovers = {}
+    for name in ("UPLOAD_DIR", "OUTPUT_DIR"):
+        directory = getattr(module, name, None)
+        if directory and os.path.isdir(directory):
+            names = os.listdir(directory)
+            leftovers[name] = {
+                "files": len(names),
+                "partial": sum(1 for n in names if n.startswith(".partial-")),
+                "progress": sum(1 for n in names if n.endswith(".progress")),
+            }
+    return leftovers
+
+
+def build_report(records: List[dict], wall_seconds: float, module, args) -> dict:
+    statuses = Counter(str(record["status"]) for record in records)
+    by_profile = defaultdict(list)
+    for record in records:
+        if record["status"] == 200:
+            by_profile[record["profile"]].append(record["latency"])
+    overhead = [r["overhead_seconds"] for r in records if r.get("overhead_seconds") is not None]
+    encode = [r["encode_seconds"] for r in records if r.get("encode_seconds") is not None and r["status"] == 200]
+    first_progress = [r["first_progress"] for r in records if r["first_progress"] is not None]
+    poll_latency = [latency for r in records for latency in r["progress_latency"]]
+    burst = [r for r in records if r["bursting"]]
+    return {
+        "app": args.app,
+        "mix": args.mix,
+        "requests": len(records),
+        "wall_seconds": round(wall_seconds, 2),
+        "throughput_rps": round(sum(1 for r in records if r["status"] == 200) / wall_seconds, 3) if wall_seconds else None,
+        "uploaded_mb": round(sum(r["bytes"] for r in records) / 1024 / 1024, 1),
+        "status_counts": dict(statuses),
+        "rejected_429_in_burst": sum(1 for r in burst if r["status"] == 429),
+        "coalesced": sum(1 for r in records if r["coalesced"]),
+        "cancelled": dict(Counter(r["cancelled"] for r in records if r["cancelled"])),
+        "latency_by_profile": {name: summarize(values) for name, values in sorted(by_profile.items())},
+        "encode_seconds": summarize(encode),
+        "overhead_seconds": summarize(overhead),
+        "time_to_first_progress": summarize(first_progress),
+        "progress_poll_latency": summarize(poll_latency),
+        "leftover_files": leftover_files(module),
+    }
+
+
+def print_report(report: dict):
+    def fmt(value):
+        return "-" if value is None else f"{value:.3f}"
+
+    def row(label: str, stats: dict):
+        print(f"  {label:<28} n={stats['count']:<5} p50={fmt(stats['p50'])}  p90={fmt(stats['p90'])}  "
+              f"p99={fmt(stats['p99'])}  max={fmt(stats['max'])}")
+
+    print(f"\n应用 {report['app']}，流量 {report['mix']}：{report['requests']} 个请求，"
+          f"耗时 {report['wall_seconds']}s，上传 {report['uploaded_mb']}MB，成功吞吐 {report['throughput_rps']} req/s")
+    print(f"状态码: {report['status_counts']}（突发期间 429: {report['rejected_429_in_burst']}）")
+    print(f"合并的重复上传: {report['coalesced']}，取消: {report['cancelled']}")
+    print("成功请求耗时（秒）:")
+    for name, stats in report["latency_by_profile"].items():
+        row(name, stats)
+    print("拆分（秒）:")
+    row("编码时间", report["encode_seconds"])
+    row("编码以外的开销", report["overhead_seconds"])
+    row("首次收到进度", report["time_to_first_progress"])
+    row("进度查询延迟", report["progress_poll_latency"])
+    print(f"残留临时文件: {report['leftover_files']}")
+
+
+# ---------------------------------------------------------------- 入口
+
+async def run(args) -> dict:
+    work_dir = prepare_environment(args)
+    module, app = load_app(args.app, work_dir)
+    rng = random.Random(args.seed)
+    model = TrafficModel(args, rng)
+    records: List[dict] = []
+
+    async with LifespanManager(app):
+        started = time.monotonic()
+        tasks = []
+        for offset, bursting in model.arrivals():
+            delay = offset - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            spec = model.make_request()
+            tasks.append(asyncio.ensure_future(
+                run_client(app, args.app, spec, offset, bursting, args, random.Random(rng.random()))
+            ))
+        for record in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(record, BaseException):
+                print(f"请求异常: {record!r}", file=sys.stderr)
+            else:
+                records.append(record)
+        wall = time.monotonic() - started
+        # 等待后台清理、被断开请求遗留的编码结束
+        await asyncio.sleep(args.settle)
+
+    attach_encode_times(records, os.environ["FAKE_FFMPEG_LOG"])
+    report = build_report(records, wall, module, args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"report": report, "requests": records}, f, ensure_ascii=False, indent=2)
+    if not args.keep:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="在进程内回放上传流量，测量排队、准入和进度推送开销")
+    parser.add_argument("--app", choices=sorted(APPS), default="main", help="被测应用")
+    parser.add_argument("--mix", choices=sorted(TRAFFIC_MIXES), default="default", help="流量组成")
+    parser.add_argument("--duration", type=float, default=30, help="产生请求的时长（秒）")
+    parser.add_argument("--rate", type=float, default=1.0, help="平均到达率（请求/秒）")
+    parser.add_argument("--burst-factor", type=float, default=5.0, help="突发期间到达率的倍数")
+    parser.add_argument("--burst-every", type=float, default=20.0, help="两次突发之间的平均间隔（秒），0 表示无突发")
+    parser.add_argument("--burst-seconds", type=float, default=4.0, help="突发的平均持续时间（秒）")
+    parser.add_argument("--clients", type=int, default=20, help="模拟的客户端（IP）数量")
+    parser.add_argument("--duplicate-rate", type=float, default=0.05, help="重复上传相同内容的比例")
+    parser.add_argument("--cancel-rate", type=float, default=0.05, help="中途取消或断开的比例（仅 main）")
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="轮询 /progress 的间隔（秒，仅 main）")
+    parser.add_argument("--no-quota", action="store_true", help="关闭按客户端的配额")
+    parser.add_argument("--speed", type=float, default=8.0, help="模拟编码速度（相对实时的倍数）")
+    parser.add_argument("--cpu", type=float, default=0.0, help="模拟编码的 CPU 占用（单核比例）")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="模拟编码随机失败的比例")
+    parser.add_argument("--fake-ffmpeg", default=FAKE_FFMPEG, help="ffmpeg 替身脚本（可替换为自定义实现）")
+    parser.add_argument("--ffmpeg-dir", help="使用该目录下的真实 ffmpeg/ffprobe，而不是替身")
+    parser.add_argument("--settle", type=float, default=1.0, help="请求结束后等待后台任务的时间（秒）")
+    parser.add_argument("--seed", type=int, default=1, help="随机种子")
+    parser.add_argument("--output", help="把报告和每个请求的明细写入 JSON 文件")
+    parser.add_argument("--keep", action="store_true", help="保留工作目录（日志、数据库）")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+    print_report(report)
+
+
+if __name__ == "__main__":
+    main()